@@ -0,0 +1,73 @@
+"""Measure the time of importing colorlabels, and check it against a fixed budget.
+
+Usage: python benchmarks/bench_import.py [--budget MILLISECONDS] [--runs N]
+
+Each run imports colorlabels in a fresh interpreter. The median import time is compared with the budget,
+and the exit status is 1 if it is exceeded or if any module which should be imported lazily is imported.
+"""
+
+import argparse
+import os
+import py_compile
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which colorlabels should not import at startup.
+LAZY_MODULES = ('getpass', 'platform', 'threading', 'heapq', 'asyncio', 'logging', 'contextvars')
+
+PROBE = '''
+import sys
+before = set(sys.modules)
+import colorlabels
+print(' '.join(sorted(set(sys.modules) - before)))
+'''
+
+
+def import_time_us():
+    """Import colorlabels in a fresh interpreter, return the import time (in microseconds) and new modules."""
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'colorlabels':
+            return int(fields[1]), result.stdout.split()
+
+    raise RuntimeError('no import time reported for colorlabels')
+
+
+def measure(runs):
+    """Return the median import time (in milliseconds) of a number of runs, and the modules imported."""
+
+    py_compile.compile(os.path.join(ROOT, 'colorlabels.py'))  # do not measure compilation
+    times = []
+    modules = []
+    for _ in range(runs):
+        elapsed, modules = import_time_us()
+        times.append(elapsed / 1000)
+    times.sort()
+    return times[len(times) // 2], modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of colorlabels.')
+    parser.add_argument('--budget', type=float, default=5, help='maximum median import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=15, help='number of fresh interpreters to measure')
+    args = parser.parse_args()
+
+    median, modules = measure(args.runs)
+    eager = [module for module in LAZY_MODULES if module in modules]
+
+    print('median import time: {:.2f} ms (budget {:.2f} ms)'.format(median, args.budget))
+    if eager:
+        print('modules imported eagerly: ' + ', '.join(eager))
+
+    return 1 if median > args.budget or eager else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
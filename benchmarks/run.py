@@ -0,0 +1,209 @@
+"""Benchmark suite of colorlabels, with JSON results to track regressions between releases.
+
+Usage: python benchmarks/run.py [--output FILE] [--quick]
+
+Label emission, progress rendering and animation overhead are measured in both TTY and non-TTY mode
+(forced with COLORLABELS_TTY, each in a fresh interpreter), with all output written to a null sink
+which only counts the characters written. Import time is measured with bench_import.py.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+LABEL_TYPES = ('section', 'item', 'success', 'warning', 'error', 'info', 'plain')
+
+
+class NullStream(object):
+    """A file-like object discarding all output, counting the characters written."""
+
+    def __init__(self):
+        self.chars = 0
+        self.writes = 0
+
+    def write(self, s):
+        self.chars += len(s)
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False  # the tty mode is forced with COLORLABELS_TTY
+
+
+def best_rate(function, count, repeat=3):
+    """Run function(count) several times, return the best number of operations per second."""
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(count)
+        best = min(best, time.perf_counter() - start)
+    return count / best
+
+
+def bench_labels(cl, null, count):
+    """Labels per second and characters per label for each label type and color span."""
+
+    results = {}
+    for color_span in (0, 1, 2, 3):
+        cl.config(color_span=color_span)
+        for label_type in LABEL_TYPES:
+            function = getattr(cl, label_type)
+
+            def run(n, function=function):
+                for i in range(n):
+                    function('benchmark message')
+
+            chars = null.chars
+            rate = best_rate(run, count)
+            results['{}/span{}'.format(label_type, color_span)] = {
+                'labels_per_sec': round(rate),
+                'chars_per_label': round((null.chars - chars) / (3 * count), 1),
+            }
+    cl.config(color_span=3)
+    return results
+
+
+def bench_overrides(cl, count):
+    """Labels per second with per-call settings, which skip the fast path."""
+
+    def run(n):
+        for i in range(n):
+            cl.info('benchmark message', mark='I', color_span=2)
+
+    return {'labels_per_sec': round(best_rate(run, count))}
+
+
+def bench_emit_many(cl, count):
+    """Labels per second printed in bulk with emit_many()."""
+
+    messages = ['benchmark message'] * count
+    return {'labels_per_sec': round(best_rate(lambda n: cl.emit_many('info', messages[:n]), count))}
+
+
+def bench_flush_modes(cl, null, count):
+    """Labels per second and writes per label in each flush mode."""
+
+    results = {}
+    for mode in ('line', 'interval', 'manual'):
+        cl.config(flush=mode)
+        writes = null.writes
+        rate = best_rate(lambda n: [cl.info('benchmark message') for i in range(n)], count)
+        cl.flush()
+        results[mode] = {
+            'labels_per_sec': round(rate),
+            'writes_per_label': round((null.writes - writes) / (3 * count), 4),
+        }
+    cl.config(flush='line')
+    return results
+
+
+def bench_update(cl, null, count):
+    """Calls per second of ProgressLabel.update() in determinate mode, with and without changing text."""
+
+    results = {}
+    for name, with_text in (('bar_only', False), ('with_text', True)):
+        chars = null.chars
+        label = cl.progress('benchmark ', mode=cl.PROGRESS_DETERMINATE)
+
+        def run(n, label=label, with_text=with_text):
+            for i in range(n):
+                label.update(i / n, ' {}'.format(i) if with_text else '')
+
+        rate = best_rate(run, count)
+        label.stop()
+        results[name] = {
+            'updates_per_sec': round(rate),
+            'chars_per_update': round((null.chars - chars) / (3 * count), 2),
+        }
+    return results
+
+
+def bench_idle_spinners(cl, num, seconds):
+    """CPU usage (percentage of one core) of idle spinning progress labels."""
+
+    labels = [cl.progress('benchmark', mode=cl.PROGRESS_SPIN) for _ in range(num)]
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    time.sleep(seconds)
+    cpu = time.process_time() - start_cpu
+    elapsed = time.perf_counter() - start
+    for label in labels:
+        label.stop()
+    return {'spinners': num, 'cpu_percent': round(100 * cpu / elapsed, 2)}
+
+
+def worker(quick):
+    """Run the benchmarks in the tty mode of this interpreter, print the results as JSON."""
+
+    import colorlabels as cl
+
+    null = NullStream()
+    cl.config(stream=null)
+    count = 2000 if quick else 20000
+
+    results = {
+        'labels': bench_labels(cl, null, count),
+        'overrides': bench_overrides(cl, count),
+        'emit_many': bench_emit_many(cl, count * 5),
+        'flush_modes': bench_flush_modes(cl, null, count),
+        'update': bench_update(cl, null, count * 5),
+        'idle_spinners': bench_idle_spinners(cl, 20, 0.5 if quick else 2),
+    }
+    json.dump(results, sys.stdout)
+
+
+def run_worker(tty, quick):
+    """Run the benchmarks in a fresh interpreter with the given tty mode forced."""
+
+    env = dict(os.environ, COLORLABELS_TTY='1' if tty else '0')
+    command = [sys.executable, os.path.abspath(__file__), '--worker']
+    if quick:
+        command.append('--quick')
+    output = subprocess.check_output(command, env=env, universal_newlines=True)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite of colorlabels.')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--quick', action='store_true', help='run fewer iterations')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.quick)
+        return
+
+    import bench_import
+
+    import_median, _ = bench_import.measure(5 if args.quick else 15)
+    results = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'import_ms': round(import_median, 3),
+        'tty': run_worker(True, args.quick),
+        'non_tty': run_worker(False, args.quick),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,137 @@
-import getpass
+import atexit
 import itertools
 import os
-import platform
 import sys
-import threading
 import time
 
+# Modules which are slow to import (getpass, platform, threading, etc.) are imported on first use,
+# since colorlabels is often imported by short-lived scripts.
+
 # Deal with Python 2 & 3 compatibility problem.
 PY2 = sys.version_info[0] < 3
 _input = raw_input if PY2 else input
-_main_thread = threading.current_thread()
+_monotonic = getattr(time, 'monotonic', time.time)
 
 
 # TTY detection and configuration.
 COLORLABELS_TTY = os.getenv('COLORLABELS_TTY')
 if COLORLABELS_TTY is None:
-    is_tty = sys.stdout.isatty()  # auto detect
+    _forced_tty = None  # auto detect
 elif COLORLABELS_TTY.lower() in {'1', 'yes', 'y', 'true', 'on'}:
-    is_tty = True  # force tty mode
+    _forced_tty = True  # force tty mode
 elif COLORLABELS_TTY.lower() in {'0', 'no', 'n', 'false', 'off'}:
-    is_tty = False  # force non-tty mode (no color or progress animations)
+    _forced_tty = False  # force non-tty mode (no color or progress animations)
 else:
     raise ValueError('invalid value {!r} for COLORLABELS_TTY'.format(COLORLABELS_TTY))
 
 
+# Output format configuration.
+#    'text' -> labels for humans to read
+#    'json' -> one JSON object per label (JSON lines), for machines to parse, without color or progress animations
+COLORLABELS_FORMAT = os.getenv('COLORLABELS_FORMAT')
+if COLORLABELS_FORMAT is None:
+    default_format = 'text'
+elif COLORLABELS_FORMAT.lower() in {'text', 'json'}:
+    default_format = COLORLABELS_FORMAT.lower()
+else:
+    raise ValueError('invalid value {!r} for COLORLABELS_FORMAT'.format(COLORLABELS_FORMAT))
+custom_format = None
+
+
+# Detect whether an output stream or file descriptor is connected to a tty, respecting COLORLABELS_TTY.
+def _detect_tty(stream):
+    if _forced_tty is not None:
+        return _forced_tty
+    try:
+        if isinstance(stream, int):
+            return os.isatty(stream)
+        return bool(stream.isatty())
+    except (AttributeError, ValueError, IOError, OSError):  # no isatty() method, or stream closed
+        return False
+
+
+_colorama_initialized = False
+
+
+# Initialize colorama on Windows when the first tty output stream is used.
+def _init_colorama():
+    global _colorama_initialized
+    if sys.platform == 'win32' and not _colorama_initialized:
+        import colorama
+        # Enabling escape sequence processing of the console also works for streams captured before
+        # initialization (e.g. a sys.stderr given to config()), unlike wrapping sys.stdout and sys.stderr.
+        getattr(colorama, 'just_fix_windows_console', colorama.init)()
+        _colorama_initialized = True
+
+
+# Detect whether stdout is a tty on first use, and cache the result as the module-level is_tty.
+def _stdout_tty():
+    global is_tty
+    try:
+        return is_tty
+    except NameError:
+        is_tty = _detect_tty(sys.stdout)
+        if is_tty:
+            _init_colorama()
+        return is_tty
+
+
+# Module-level attributes computed on first access.
+def __getattr__(name):
+    if name == 'is_tty':
+        return _stdout_tty()
+    if name in {'LabelHandler', 'LabelFormatter'}:
+        return _make_logging_classes()[name]
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+if sys.version_info < (3, 7):  # no module-level __getattr__()
+    _stdout_tty()
+
+
 def color_code(color_number):
     """Generate an ANSI escape sequence with the given color number or description string."""
     return '\033[' + str(color_number) + 'm'
 
 
+# Check whether a value is an integer in range [0, 255].
+def _check_color_component(value, field):
+    if not isinstance(value, int):
+        raise TypeError('{!r} should be an integer'.format(field))
+    if value < 0 or value > 255:
+        raise ValueError('{!r} should be in range [0, 255]'.format(field))
+
+
+def color256(color_number, background=False):
+    """Generate an ANSI escape sequence of a color in the 256-color palette."""
+    _check_color_component(color_number, 'color_number')
+    return color_code(('48;5;' if background else '38;5;') + str(color_number))
+
+
+def rgb(red, green, blue, background=False):
+    """Generate an ANSI escape sequence of a 24-bit (truecolor) RGB color."""
+    _check_color_component(red, 'red')
+    _check_color_component(green, 'green')
+    _check_color_component(blue, 'blue')
+    return color_code('{};2;{};{};{}'.format(48 if background else 38, red, green, blue))
+
+
+def hex_color(code, background=False):
+    """Generate an ANSI escape sequence of a 24-bit (truecolor) color given as a hex string like '#ff8700'."""
+    if not isinstance(code, str):
+        raise TypeError("'code' should be a string")
+    digits = code[1:] if code.startswith('#') else code
+    if len(digits) == 3:
+        digits = ''.join(digit * 2 for digit in digits)
+    try:
+        if len(digits) != 6:
+            raise ValueError
+        value = int(digits, 16)
+    except ValueError:
+        raise ValueError("'code' should be a hex color like '#ff8700' or '#f80'")
+    return rgb(value >> 16, (value >> 8) & 0xff, value & 0xff, background)
+
+
 # Standard colors.
 BLACK = color_code(30)
 RED = color_code(31)
@@ -46,6 +149,9 @@ BRIGHT_BLUE = color_code(94)
 BRIGHT_MAGENTA = color_code(95)
 BRIGHT_CYAN = color_code(96)
 BRIGHT_WHITE = color_code(97)
+BOLD = color_code(1)
+DIM = color_code(2)
+UNDERLINE = color_code(4)
 COLOR_RESET = color_code(0)  # Reset color settings in console.
 COLOR_NONE = ''  # Does not change color.
 CLEAR_LINE = '\r\033[K'  # Erase all characters on the line.
@@ -102,6 +208,12 @@ custom_marks = {}
 for _label_type in all_labels:
     custom_marks[_label_type] = None
 
+# Label types displaying a message only.
+_message_labels = ('section', 'item', 'success', 'warning', 'error', 'info', 'progress', 'plain')
+
+# Number of labels rendered and written at once by emit_many().
+_emit_chunk_size = 1000
+
 # Header pattern.
 header_pattern = '[{mark}]'
 
@@ -109,6 +221,35 @@ header_pattern = '[{mark}]'
 default_show_header = True
 custom_show_header = None
 
+# Default and custom inline markup settings, see _compile_markup().
+default_markup = False
+custom_markup = None
+
+# Default and custom output flushing settings.
+#    'line'     -> flush after every label
+#    'interval' -> buffer output, flush when the buffer is full or 'flush_interval' seconds have passed
+#    'manual'   -> buffer output, flush only when the buffer is full or flush() is called
+# Progress animations and input prompts are always flushed immediately.
+default_flush_mode = 'line'
+custom_flush_mode = None
+default_flush_interval = 1.0
+custom_flush_interval = None
+default_buffer_size = 65536
+custom_buffer_size = None
+
+# Custom setting of the output stream of labels (a file-like object or a file descriptor).
+# Labels are written to sys.stdout if it is None.
+custom_stream = None
+
+# Default and custom settings of suppressing repeated labels.
+#    dedup      -> whether to collapse identical consecutive labels into one line with a repeat counter
+#    rate_limit -> maximum number of labels per second of each label type (a number for all label types,
+#                  or a dict of label types to numbers), None for no limit
+default_dedup = False
+custom_dedup = None
+default_rate_limit = None
+custom_rate_limit = None
+
 # Modes of the progress label.
 PROGRESS_STATIC = 0
 PROGRESS_SPIN = 1
@@ -142,6 +283,12 @@ default_progress_config = {
         'char_head': '>',
         'char_undone': ' ',
         'width': 40,
+        'min_interval': 0,
+        'total': None,
+        'unit': 'it',
+        'smoothing': 0.3,
+        'milestone_step': 10,
+        'milestone_interval': 30,
         'cleanup': False,
         'erase': False
     }
@@ -150,10 +297,246 @@ default_progress_config = {
 
 # Internal functions.
 
-# Check whether the color is valid.
+# Number of bits of colors supported by the terminal (4, 8 or 24), detected on first use from COLORTERM and TERM.
+_color_depth = None
+
+
+# Get the number of bits of colors supported by the terminal.
+def _get_color_depth():
+    global _color_depth
+    if _color_depth is None:
+        colorterm = os.getenv('COLORTERM', '').lower()
+        term = os.getenv('TERM', '').lower()
+        if colorterm in {'truecolor', '24bit'} or term.endswith('-direct'):
+            _color_depth = 24
+        elif '256' in term:
+            _color_depth = 8
+        else:
+            _color_depth = 4
+    return _color_depth
+
+
+# The 16 standard colors of the xterm palette, in order of SGR codes 30-37 and 90-97.
+_standard_colors = ((0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0), (0, 0, 238), (205, 0, 205), (0, 205, 205),
+                    (229, 229, 229), (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0), (92, 92, 255),
+                    (255, 0, 255), (0, 255, 255), (255, 255, 255))
+_cube_levels = (0, 95, 135, 175, 215, 255)
+
+
+# Get the RGB value of a color in the 256-color palette.
+def _color256_to_rgb(number):
+    if number < 16:
+        return _standard_colors[number]
+    if number >= 232:  # grayscale ramp
+        level = 8 + 10 * (number - 232)
+        return level, level, level
+    number -= 16
+    return _cube_levels[number // 36], _cube_levels[number // 6 % 6], _cube_levels[number % 6]
+
+
+# Get the index of the nearest level of the 6x6x6 color cube of the 256-color palette.
+def _cube_index(value):
+    if value < 48:
+        return 0
+    if value < 115:
+        return 1
+    return (value - 35) // 40
+
+
+# Get the nearest color in the 256-color palette of an RGB value.
+def _rgb_to_color256(red, green, blue):
+    if red == green == blue:
+        if red < 8:
+            return 16
+        if red > 248:
+            return 231
+        return 232 + int(round((red - 8) / 247.0 * 23))
+    return 16 + 36 * _cube_index(red) + 6 * _cube_index(green) + _cube_index(blue)
+
+
+# Get the index of the nearest standard color of an RGB value.
+def _rgb_to_standard(red, green, blue):
+    return min(range(16), key=lambda i: (_standard_colors[i][0] - red) ** 2 + (_standard_colors[i][1] - green) ** 2 +
+               (_standard_colors[i][2] - blue) ** 2)
+
+
+# Get the SGR parameters of a standard color given its index, as foreground or background color.
+def _standard_color_params(index, background):
+    base = 40 if background else 30
+    return [str(base + index if index < 8 else base + 60 + index - 8)]
+
+
+# Downgrade the SGR parameters of an extended color to the given color depth.
+def _downgrade_color_params(background, number, rgb_value, depth):
+    prefix = '48' if background else '38'
+    if rgb_value is not None:
+        if depth >= 24:
+            return [prefix, '2'] + [str(component) for component in rgb_value]
+        if depth == 8:
+            return [prefix, '5', str(_rgb_to_color256(*rgb_value))]
+        return _standard_color_params(_rgb_to_standard(*rgb_value), background)
+    if depth >= 8:
+        return [prefix, '5', str(number)]
+    if number < 16:
+        return _standard_color_params(number, background)
+    return _standard_color_params(_rgb_to_standard(*_color256_to_rgb(number)), background)
+
+
+# Convert the 256-color and truecolor sequences of a color to the given color depth.
+def _convert_color(color, depth):
+    sequences = []
+    for part in color.split('\033[')[1:]:
+        params = part[:-1].split(';')
+        converted = []
+        i = 0
+        while i < len(params):
+            if params[i] in {'38', '48'} and i + 2 < len(params) and params[i + 1] == '5':
+                number = int(params[i + 2] or 0)
+                converted += _downgrade_color_params(params[i] == '48', min(number, 255), None, depth)
+                i += 3
+            elif params[i] in {'38', '48'} and i + 4 < len(params) and params[i + 1] == '2':
+                rgb_value = tuple(min(int(param or 0), 255) for param in params[i + 2:i + 5])
+                converted += _downgrade_color_params(params[i] == '48', None, rgb_value, depth)
+                i += 5
+            else:
+                converted.append(params[i])
+                i += 1
+        sequences.append(color_code(';'.join(converted)))
+    return ''.join(sequences)
+
+
+# Get a value from a least recently used cache, computing it from the key on a miss.
+# (Eviction follows insertion order, which is arbitrary before Python 3.7.)
+def _lru_get(cache, key, compute, max_size):
+    try:
+        value = cache.pop(key)
+    except KeyError:
+        value = compute(key)
+        if len(cache) >= max_size:
+            cache.pop(next(iter(cache)), None)
+    cache[key] = value  # (re)insert as the most recently used
+    return value
+
+
+# Cache of colors downgraded to the color depth of the terminal, keyed on color and depth.
+_downgraded_colors = {}
+_max_downgraded_colors = 256
+
+
+# Downgrade a color to the color depth of the terminal.
+def _downgrade_color(color):
+    if '8;' not in color:  # no extended colors
+        return color
+    return _lru_get(_downgraded_colors, (color, _get_color_depth()), lambda key: _convert_color(*key),
+                    _max_downgraded_colors)
+
+
+# Colors and styles available as markup tags, built on first use.
+_markup_styles = None
+
+
+# Get the escape sequence of a markup tag name, which is made of space-separated color or style names
+# (e.g. 'red', 'bold bright_green'), 256-color numbers (e.g. 'color208') or hex colors. Return None for unknown names.
+def _markup_style(name):
+    global _markup_styles
+    if _markup_styles is None:
+        _markup_styles = dict((key.lower(), globals()[key]) for key in (
+            'BLACK', 'RED', 'GREEN', 'YELLOW', 'BLUE', 'MAGENTA', 'CYAN', 'WHITE', 'BRIGHT_BLACK', 'BRIGHT_RED',
+            'BRIGHT_GREEN', 'BRIGHT_YELLOW', 'BRIGHT_BLUE', 'BRIGHT_MAGENTA', 'BRIGHT_CYAN', 'BRIGHT_WHITE',
+            'BOLD', 'DIM', 'UNDERLINE'))
+
+    style = ''
+    for word in name.split(' '):
+        if word in _markup_styles:
+            style += _markup_styles[word]
+        elif word.startswith('color') and word[5:].isdigit() and int(word[5:]) <= 255:
+            style += color256(int(word[5:]))
+        elif word.startswith('#'):
+            try:
+                style += hex_color(word)
+            except ValueError:
+                return None
+        else:
+            return None
+    return _downgrade_color(style)
+
+
+# Least recently used cache of compiled markup, keyed on message.
+_compiled_markup = {}
+_max_compiled_markup = 1024
+
+
+# Parse inline markup in a message into a tuple of (text, style) segments, where style is the escape sequence
+# of the tags enclosing the text. '{name}' opens a tag, '{/}' closes the innermost tag, and '{{' is a literal '{'.
+# Unknown tags are kept as text.
+def _parse_markup(msg):
+    segments = []
+    styles = ['']
+    text = []
+    start = 0
+    while True:
+        left = msg.find('{', start)
+        if left >= 0 and msg.startswith('{{', left):
+            text.append(msg[start:left + 1])
+            start = left + 2
+            continue
+        right = msg.find('}', left + 1) if left >= 0 else -1
+        if right < 0:
+            text.append(msg[start:])
+            break
+
+        name = msg[left + 1:right]
+        style = None if name == '/' else _markup_style(name)
+        if name != '/' and style is None:
+            text.append(msg[start:right + 1])
+            start = right + 1
+            continue
+
+        text.append(msg[start:left])
+        if ''.join(text):
+            segments.append((''.join(text), styles[-1]))
+        text = []
+        if style is None:
+            if len(styles) > 1:
+                styles.pop()
+        else:
+            styles.append(styles[-1] + style)
+        start = right + 1
+
+    if ''.join(text):
+        segments.append((''.join(text), styles[-1]))
+    return tuple(segments)
+
+
+# Render a message with inline markup. The color of the label (outer color) is restored after each tag,
+# and markup is stripped if the outer color is None.
+def _render_markup(msg, outer):
+    segments = _lru_get(_compiled_markup, msg, _parse_markup, _max_compiled_markup)
+    if outer is None:
+        return ''.join([text for text, style in segments])
+
+    out = []
+    current = ''
+    for text, style in segments:
+        if style != current:
+            if style.startswith(current):  # nested tag
+                out.append(style[len(current):])
+            else:
+                out.append(COLOR_RESET + outer + style)
+            current = style
+        out.append(text)
+    if current:
+        out.append(COLOR_RESET + outer)
+    return ''.join(out)
+
+
+# Check whether the color is valid, i.e. made of ANSI SGR escape sequences like '\033[1;38;5;208m', or empty.
 def _check_color(color):
     if not isinstance(color, str):
         raise TypeError("'color' should be a string")
+    parts = color.split('\033[')
+    if parts[0] or not all(part.endswith('m') and not part[:-1].strip('0123456789;') for part in parts[1:]):
+        raise ValueError("'color' should be made of ANSI escape sequences setting colors or styles")
 
 
 # Check whether color span is valid.
@@ -170,6 +553,38 @@ def _check_mark(mark):
         raise TypeError("'mark' should be a string")
 
 
+# Check whether flush mode is valid.
+def _check_flush_mode(mode):
+    if mode not in {'line', 'interval', 'manual'}:
+        raise ValueError("'flush' should be one of 'line', 'interval' or 'manual'")
+
+
+# Check whether output format is valid.
+def _check_format(output_format):
+    if output_format not in {'text', 'json'}:
+        raise ValueError("'format' should be 'text' or 'json'")
+
+
+# Check whether an output stream is valid.
+def _check_stream(stream, field):
+    if stream is None or isinstance(stream, int):
+        return
+    if not callable(getattr(stream, 'write', None)):
+        raise TypeError('{!r} should be a file-like object or a file descriptor'.format(field))
+
+
+# Check whether a rate limit setting is valid.
+def _check_rate_limit(rate_limit):
+    if rate_limit is None:
+        return
+    if isinstance(rate_limit, dict):
+        for label_type, rate in rate_limit.items():
+            _check_value_in_list(label_type, 'rate_limit', _message_labels)
+            _check_positive_number(rate, 'rate_limit')
+    else:
+        _check_positive_number(rate_limit, 'rate_limit')
+
+
 # Check whether progress mode is valid.
 def _check_progress_mode(mode):
     if mode not in {PROGRESS_STATIC, PROGRESS_SPIN, PROGRESS_EXPAND, PROGRESS_MOVE, PROGRESS_DETERMINATE}:
@@ -192,6 +607,14 @@ def _check_positive_number(value, field):
         raise ValueError('{!r} should be a positive number'.format(field))
 
 
+# Check whether a value is a non-negative number.
+def _check_nonnegative_number(value, field):
+    if not isinstance(value, (int, float)):
+        raise TypeError('{!r} should be a number'.format(field))
+    if value < 0:
+        raise ValueError('{!r} should be a non-negative number'.format(field))
+
+
 # Check whether a value is a character.
 def _check_character(value, field):
     if not isinstance(value, str):
@@ -238,152 +661,1086 @@ def _layered_choice(*args):
     return None
 
 
-# Print a string to stdout without appending '\n', and flush stdout.
-def _inline_write(s):
-    sys.stdout.write(s)
-    sys.stdout.flush()
+class _Style(object):
+    """A snapshot of the label settings in effect in a scope, resolved from the scoped settings,
+    runtime global settings and defaults, with the compiled templates of labels printed without
+    per-call settings. Labels only read the settings, so a style can be shared between threads."""
 
+    __slots__ = ('version', 'color_span', 'show_header', 'markup', 'colors', 'marks', 'templates')
 
-# Display a generic message label.
-def _print_label(color, mark, msg, newline=True, reset_color=True, clear_line=True, **kwargs):
-    color_span = _layered_choice(kwargs.get('color_span'), custom_color_span, default_color_span)
-    show_header = _layered_choice(kwargs.get('show_header'), custom_show_header, default_show_header)
-    msg = str(msg)
+    def __init__(self, version, settings):
+        self.version = version  # version of runtime global settings
+        self.color_span = _layered_choice(settings.get('color_span'), custom_color_span, default_color_span)
+        self.show_header = _layered_choice(settings.get('show_header'), custom_show_header, default_show_header)
+        self.markup = _layered_choice(settings.get('markup'), custom_markup, default_markup)
+        self.colors = dict((label, _layered_choice(settings.get(label + '_color'), custom_colors[label],
+                                                   default_colors[label])) for label in all_labels)
+        self.marks = dict((label, _layered_choice(settings.get(label + '_mark'), custom_marks[label],
+                                                  default_marks[label])) for label in all_labels)
+        self.templates = {}  # keyed on label type, sink tty mode, header pattern and output format
+
+
+# Style of runtime global settings, replaced by config().
+_style_version = 0
+_global_style = _Style(_style_version, {})
+
+
+class _Scope(object):
+    """Label settings of a scope of configured(), including those of enclosing scopes."""
+
+    __slots__ = ('settings', 'style')
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.style = _Style(_style_version, settings)
+
+
+class _LocalVar(object):
+    """A thread-local variable with the interface of contextvars.ContextVar, for Python < 3.7."""
+
+    def __init__(self):
+        import threading
+        self.local = threading.local()
+
+    def get(self):
+        return getattr(self.local, 'value', None)
+
+    def set(self, value):
+        token = self.get()
+        self.local.value = value
+        return token
+
+    def reset(self, token):
+        self.local.value = token
+
+
+# Context variable holding the current scope of configured(), created on first use.
+_scope_var = None
+
+
+# Get the context variable holding the current scope.
+def _get_scope_var():
+    global _scope_var
+    if _scope_var is None:
+        try:
+            import contextvars
+            _scope_var = contextvars.ContextVar('colorlabels_scope', default=None)
+        except ImportError:  # Python < 3.7
+            _scope_var = _LocalVar()
+    return _scope_var
+
+
+# Get the style in effect in the current thread or asyncio task.
+def _current_style():
+    if _scope_var is None:
+        return _global_style
+    scope = _scope_var.get()
+    if scope is None:
+        return _global_style
+    if scope.style.version != _style_version:  # runtime global settings changed since the snapshot
+        scope.style = _Style(_style_version, scope.settings)
+    return scope.style
+
+
+class _Configured(object):
+    """Context manager applying label settings within its scope, returned by configured()."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.tokens = []
+
+    def __enter__(self):
+        var = _get_scope_var()
+        outer = var.get()
+        settings = dict(outer.settings) if outer is not None else {}
+        settings.update(self.settings)
+        self.tokens.append(var.set(_Scope(settings)))
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        _scope_var.reset(self.tokens.pop())
+
+
+# Effective output flushing settings, resolved by config().
+_flush_mode = default_flush_mode
+_flush_interval = default_flush_interval
+_buffer_size = default_buffer_size
+_atexit_registered = False
+
+
+class _Sink(object):
+    """An output destination of labels, with its own tty mode, output buffer and write lock.
+
+    A sink may have a live object (a running progress animation), whose display stays at the end of the output.
+    Other output written to the sink is inserted before it, by clearing and then redrawing the live display.
+    A live object provides the '_live_clear()' and '_live_redraw()' methods for that."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.serial = next(_sink_serials)
+        self.tty = _detect_tty(stream)
+        if self.tty:
+            _init_colorama()
+        self._init_state()
+
+    def _init_state(self):
+        import threading
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.buffer_length = 0
+        self.last_flush_time = 0
+        self.live = None
+        self.writes = 0  # number of writes other than live display updates
+        self.flush_timer = None  # pending deferred flush in 'interval' flush mode
+
+    def _write(self, s):
+        self.stream.write(s)
+
+    def _flush(self):
+        self.stream.flush()
+
+    def flush(self, s=''):
+        """Write all pending output (followed by s) to the stream and flush the stream."""
+
+        with self.lock:
+            if self.buffer:
+                self.buffer.append(s)
+                s = ''.join(self.buffer)
+                del self.buffer[:]
+                self.buffer_length = 0
+
+            if s:
+                self._write(s)
+            self._flush()
+            self.last_flush_time = time.time()
+
+    def write(self, s, flush=False, live=None, label_type=None):
+        """Write a string to the stream, which is flushed according to the flush mode,
+        or immediately if flush is True.
+
+        If live is given, the string is a display update of that live object, and it is flushed immediately.
+        The label type of the output (if known) is only used by the active recorder."""
+
+        with self.lock:
+            if live is not None:
+                self.live = live
+                flush = True
+            else:
+                self.writes += 1
+                if self.live is not None and self.tty:
+                    s = self.live._live_clear() + s + self.live._live_redraw()
+
+            recorder = _recorder  # read once, as it may be stopped by another thread
+            if recorder is not None:
+                recorder._record(label_type, s)
+
+            if flush or _flush_mode == 'line':
+                self.flush(s)
+                return
+
+            self.buffer.append(s)
+            self.buffer_length += len(s)
+            if self.buffer_length >= _buffer_size or \
+                    (_flush_mode == 'interval' and time.time() - self.last_flush_time >= _flush_interval):
+                self.flush()
+                return
+
+            timer = None
+            if _flush_mode == 'interval' and self.flush_timer is None:
+                timer = self.flush_timer = _FlushTimer(self)
+
+        # Arm the timer outside the sink lock, as the scheduler holds its lock while flushing.
+        if timer is not None:
+            _get_scheduler().add(timer, _flush_interval)
 
+    def end_live(self, live):
+        """Detach a live object from the sink, so that its display is no longer redrawn."""
+
+        with self.lock:
+            if self.live is live:
+                self.live = None
+                self.writes += 1  # the last display of the live object stays on the screen as written output
+
+
+class _FlushTimer(object):
+    """A one-shot animation flushing a sink, so that output does not stay buffered longer than the flush
+    interval when no more labels are written."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.stopped = False
+
+    def _tick(self):
+        sink = self.sink
+        with sink.lock:
+            sink.flush_timer = None
+            if sink.buffer:
+                sink.flush()
+        self.stopped = True
+        return 0
+
+
+class _FdSink(_Sink):
+    """A sink writing encoded output directly to a file descriptor with os.write()."""
+
+    encoding = 'utf-8'
+
+    def _write(self, s):
+        data = s if isinstance(s, bytes) else s.encode(self.encoding, 'replace')
+        while data:
+            data = data[os.write(self.stream, data):]
+
+    def _flush(self):
+        pass
+
+
+class _StdoutSink(_Sink):
+    """The default sink, which follows the current sys.stdout and the module-level tty mode."""
+
+    stream = property(lambda self: sys.stdout)
+    tty = property(lambda self: _stdout_tty())
+
+    def __init__(self):
+        self._init_state()
+
+
+_stdout_sink = None  # created on first use
+
+# The active recorder of label output, see Recorder.
+_recorder = None
+
+# Sinks of explicitly given output streams, keyed on the stream.
+_sinks = {}
+_sink_serials = itertools.count()  # creation order of sinks
+
+# Maximum number of sinks of explicitly given output streams kept at the same time.
+_max_sinks = 64
+
+
+# Get the sink of an output stream, or of the configured output stream if it is None.
+def _get_sink(stream=None):
+    global _stdout_sink
+
+    if stream is None:
+        stream = custom_stream
+    elif isinstance(stream, _Sink):
+        return stream
+
+    # Labels written to sys.stdout share the default sink, with its buffer, lock and live display.
+    if stream is None or stream is sys.stdout:
+        if _stdout_sink is None:
+            _stdout_sink = _StdoutSink()
+        return _stdout_sink
+
+    sink = _sinks.get(stream)
+    if sink is None:
+        _check_stream(stream, 'file')
+        if len(_sinks) >= _max_sinks:
+            _flush_all()
+            _sinks.clear()
+        sink = _sinks.setdefault(stream, _FdSink(stream) if isinstance(stream, int) else _Sink(stream))
+    return sink
+
+
+# Get all sinks created so far, the stdout sink first and the others in order of creation.
+def _all_sinks():
+    sinks = sorted(_sinks.values(), key=lambda sink: sink.serial)
+    if _stdout_sink is not None:
+        sinks.insert(0, _stdout_sink)
+    return sinks
+
+
+# Write all pending output of all sinks.
+def _flush_all():
+    suppressor = _suppressor
+    if suppressor is not None:
+        suppressor.finish()
+    for sink in _all_sinks():
+        sink.flush()
+
+
+# Flush pending output at interpreter exit, ignoring already closed streams.
+def _flush_all_at_exit():
+    suppressor = _suppressor
+    if suppressor is not None:
+        try:
+            suppressor.finish()
+        except (IOError, OSError, ValueError):
+            pass
+    for sink in _all_sinks():
+        try:
+            sink.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+
+# Effective output format, resolved by config().
+_output_format = default_format
+
+
+# Whether labels written to a sink can use color and progress animations.
+def _interactive(sink):
+    return sink.tty and _output_format == 'text'
+
+
+# Print a string to the given output stream without appending '\n'.
+# The stream is flushed according to the flush mode, or immediately if flush is True.
+def _inline_write(s, flush=False, file=None, label_type=None):
+    _get_sink(file).write(s, flush, label_type=label_type)
+
+
+# Cache of compiled label templates, keyed on everything that affects the rendered text around the message.
+# Cleared by config().
+_label_templates = {}
+
+# Maximum number of entries kept in the label template caches.
+_max_cached_templates = 1024
+
+
+# Render the text surrounding the message of a label, so that the label is printed as prefix + msg + suffix.
+def _compile_label(color, mark, color_span, show_header, tty, newline=True, reset_color=True, clear_line=True):
     _check_color(color)
     _check_color_span(color_span)
     _check_mark(mark)
 
-    if not is_tty:  # disable color output for non-tty mode
+    if not tty:  # disable color output for non-tty mode
         color_span = 0
+    elif color_span:
+        color = _downgrade_color(color)
 
     if show_header:
         if color_span == 0:  # No color.
-            out_string = header_pattern.format(mark=mark) + ' ' + msg
+            prefix = header_pattern.format(mark=mark) + ' '
+            suffix = ''
         elif color_span == 1:  # Color the mark.
-            out_string = header_pattern.format(mark=color + mark + COLOR_RESET) + ' ' + msg
+            prefix = header_pattern.format(mark=color + mark + COLOR_RESET) + ' '
+            suffix = ''
         elif color_span == 2:  # Color the header.
-            out_string = color + header_pattern.format(mark=mark) + COLOR_RESET + ' ' + msg
+            prefix = color + header_pattern.format(mark=mark) + COLOR_RESET + ' '
+            suffix = ''
         else:  # Color the whole line.
-            out_string = color + header_pattern.format(mark=mark) + ' ' + msg \
-                         + (COLOR_RESET if reset_color else COLOR_NONE)
+            prefix = color + header_pattern.format(mark=mark) + ' '
+            suffix = COLOR_RESET if reset_color else COLOR_NONE
     else:
         if color_span <= 2:
-            out_string = msg
+            prefix = suffix = ''
         else:
-            out_string = color + msg + (COLOR_RESET if reset_color else COLOR_NONE)
+            prefix = color
+            suffix = COLOR_RESET if reset_color else COLOR_NONE
 
-    if clear_line and is_tty:
-        out_string = CLEAR_LINE + out_string
+    if clear_line and tty:
+        prefix = CLEAR_LINE + prefix
 
     if newline:
-        out_string += '\n'
+        suffix += '\n'
+
+    return prefix, suffix
+
+
+# Store a compiled template in a cache, evicting everything once the cache grows too large.
+def _cache_template(cache, key, template):
+    if len(cache) >= _max_cached_templates:
+        cache.clear()
+    cache[key] = template
+    return template
+
+
+# Cache of compiled JSON record templates, keyed on label type and mark. Cleared by config().
+_json_templates = {}
 
-    _inline_write(out_string)
+# Function encoding a string as a JSON string literal, set when the first JSON template is compiled.
+_json_string = None
+
+
+# Get the compiled template of a label in JSON format. The suffix of the template is None, and labels are
+# printed as prefix + JSON string of msg + ',"time":' + timestamp + extra fields + '}\n', see _write_label().
+def _get_json_template(label_type, mark):
+    global _json_string
+
+    key = (label_type, mark)
+    template = _json_templates.get(key)
+    if template is None:
+        _check_mark(mark)
+        if _json_string is None:
+            import json
+            _json_string = json.encoder.encode_basestring_ascii
+        template = _cache_template(_json_templates, key, (
+            '{"type":' + _json_string(label_type) + ',"mark":' + _json_string(mark) + ',"message":', None))
+    return template
+
+
+# Render a JSON record of a label with its compiled template, containing the given extra fields.
+def _json_record(template, msg, timestamp, extra=''):
+    return template[0] + _json_string(str(msg)) + ',"time":' + timestamp + extra + '}\n'
+
+
+# Get a timestamp to put into JSON records.
+def _json_timestamp():
+    return '{:.6f}'.format(time.time())
+
+
+# Write a label with its compiled template to a sink.
+def _write_label(sink, template, msg, flush=False, label_type=None):
+    suppressor = _suppressor  # read once, as it may be replaced by config() on another thread
+    if suppressor is not None and label_type is not None and (template[1] is None or template[1][-1:] == '\n'):
+        suppressor.write(sink, template, str(msg), flush, label_type)
+        return
+
+    if template[1] is None:
+        sink.write(_json_record(template, msg, _json_timestamp()), flush, label_type=label_type)
+    else:
+        sink.write(template[0] + str(msg) + template[1], flush, label_type=label_type)
+
+
+# Render a label with a compiled template, with a repeat counter if repeated is given.
+def _render_label(template, msg, repeated=None):
+    if template[1] is None:
+        return _json_record(template, msg, _json_timestamp(), ',"repeated":{}'.format(repeated) if repeated else '')
+    return template[0] + msg + (' (x{})'.format(repeated) if repeated else '') + template[1]
+
+
+# Minimum time (in seconds) between two rewrites of the repeat counter of a label in tty mode.
+_dedup_interval = 0.1
+
+
+class _Suppressor(object):
+    """Suppressor of repeated labels, which collapses identical consecutive labels on each sink into one line
+    with a repeat counter, and limits the rate of labels of each label type with token buckets.
+
+    Only the last label of each sink is kept, so that memory use does not grow with the labels.
+    In tty mode, the line of the repeated label is rewritten in place with the counter (at most every 0.1
+    seconds). Otherwise, the label is written again with the counter when another label is written to the
+    sink or output is flushed. The number of labels suppressed by rate limits is reported in the same way."""
+
+    def __init__(self, dedup, rate_limit):
+        import threading
+
+        self.dedup = dedup
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.last = {}  # sink -> [template, message, count, count displayed, sink writes, time displayed]
+        self.buckets = {}  # label type -> [tokens, time, suppressed count, sink, template]
+
+    def _rate(self, label_type):
+        if isinstance(self.rate_limit, dict):
+            return self.rate_limit.get(label_type)
+        return self.rate_limit
+
+    # Take a token from the bucket of a label type, and return whether the label can be written.
+    def _take_token(self, label_type, sink, template, now):
+        rate = self._rate(label_type)
+        if rate is None:
+            return True
+
+        # Burst up to one second of labels, and at least one label so that rates below 1 per second work.
+        burst = max(rate, 1)
+        bucket = self.buckets.get(label_type)
+        if bucket is None:
+            bucket = self.buckets[label_type] = [burst, now, 0, None, None]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+
+        bucket[2] += 1
+        bucket[3] = sink
+        bucket[4] = template
+        return False
+
+    # Report the labels of a label type suppressed by its rate limit so far.
+    def _report_suppressed(self, label_type):
+        bucket = self.buckets.get(label_type)
+        if bucket is not None and bucket[2]:
+            msg = '({} {} labels suppressed by rate limit)'.format(bucket[2], label_type)
+            bucket[3].write(_render_label(bucket[4], msg), label_type=label_type)
+            bucket[2] = 0
+
+    # Display the final repeat counter of the last label of a sink.
+    def _finish_sink(self, sink, state):
+        if state[2] > state[3]:
+            self._display_count(sink, state)
+
+    def _display_count(self, sink, state):
+        line = _render_label(state[0], state[1], state[2])
+        if sink.tty and state[0][1] is not None and state[4] == sink.writes:
+            line = '\033[1A' + line  # overwrite the line of the label, which is still the last one
+        sink.write(line)
+        state[3] = state[2]
+        state[4] = sink.writes
+        state[5] = _monotonic()
+
+    def write(self, sink, template, msg, flush, label_type):
+        with self.lock:
+            now = _monotonic()
+            if self.dedup:
+                state = self.last.get(sink)
+                if state is not None and state[0] == template and state[1] == msg:
+                    state[2] += 1
+                    if sink.tty and template[1] is not None and now - state[5] >= _dedup_interval:
+                        self._display_count(sink, state)
+                    return
+                if state is not None:
+                    self._finish_sink(sink, state)
+
+            if not self._take_token(label_type, sink, template, now):
+                return
+            self._report_suppressed(label_type)
+
+            sink.write(_render_label(template, msg), flush, label_type=label_type)
+            if self.dedup:
+                if len(self.last) >= _max_sinks:
+                    self.last.clear()
+                self.last[sink] = [template, msg, 1, 1, sink.writes, now]
+
+    def finish(self):
+        """Display the final repeat counters and the numbers of suppressed labels."""
+
+        with self.lock:
+            for sink, state in list(self.last.items()):
+                self._finish_sink(sink, state)
+            for label_type in list(self.buckets):
+                self._report_suppressed(label_type)
+
+
+# The active suppressor of repeated labels, set by config().
+_suppressor = None
+
+
+# Get the compiled template of a label printed to the given sink, with per-call settings in kwargs.
+def _get_template(color, mark, sink, kwargs, newline=True, reset_color=True, clear_line=True,
+                  label_type='progress'):
+    if _output_format == 'json':
+        return _get_json_template(label_type, mark)
+
+    style = _current_style()
+    color_span = _layered_choice(kwargs.get('color_span'), style.color_span)
+    show_header = _layered_choice(kwargs.get('show_header'), style.show_header)
+    tty = sink.tty
+    key = (color, mark, color_span, show_header, tty, header_pattern, newline, reset_color, clear_line)
+
+    try:
+        template = _label_templates.get(key)
+    except TypeError:  # unhashable settings, let _compile_label() report them
+        template = _compile_label(color, mark, color_span, show_header, tty, newline, reset_color, clear_line)
+
+    if template is None:
+        template = _cache_template(_label_templates, key, _compile_label(color, mark, color_span, show_header,
+                                                                         tty, newline, reset_color, clear_line))
+
+    return template
+
+
+# Get the color to restore after markup tags in a label (None to strip markup), with per-call settings in kwargs.
+def _markup_outer_color(color, sink, kwargs):
+    if not _interactive(sink):  # strip markup in non-tty mode and JSON output
+        return None
+    color_span = _layered_choice(kwargs.get('color_span'), _current_style().color_span)
+    return _downgrade_color(color) if color_span == 3 else ''
+
+
+# Render inline markup in the message of a label if enabled, with per-call settings in kwargs.
+def _apply_markup(color, msg, sink, kwargs):
+    if not _layered_choice(kwargs.get('markup'), _current_style().markup):
+        return msg
+    msg = str(msg)
+    if '{' not in msg:
+        return msg
+    return _render_markup(msg, _markup_outer_color(color, sink, kwargs))
+
+
+# Display a generic message label.
+def _print_label(color, mark, msg, newline=True, reset_color=True, clear_line=True, flush=False, file=None,
+                 label_type='progress', **kwargs):
+    sink = _get_sink(file)
+    template = _get_template(color, mark, sink, kwargs, newline, reset_color, clear_line, label_type)
+    _write_label(sink, template, _apply_markup(color, msg, sink, kwargs), flush, label_type)
 
 
 # Display a generic input label.
-def _input_label(color, mark, msg, **kwargs):
-    _print_label(color, mark, msg, newline=False, reset_color=False, **kwargs)
+def _input_label(label_type, color, mark, msg, **kwargs):
+    _print_label(color, mark, msg, newline=False, reset_color=False, flush=True, label_type=label_type, **kwargs)
     try:
         input_data = _input()
     finally:
-        if is_tty:
-            _inline_write(COLOR_RESET)  # Ensure color reset.
+        sink = _get_sink(kwargs.get('file'))
+        if _interactive(sink):
+            sink.write(COLOR_RESET, flush=True, label_type=label_type)  # Ensure color reset.
     return input_data
 
 
 # Perform the final print of a progress label.
 def _progress_final(color, mark, msg, **kwargs):
     if kwargs['erase']:
-        _inline_write(CLEAR_LINE)
+        _inline_write(CLEAR_LINE, flush=True, file=kwargs.get('file'), label_type='progress')
     else:
-        _print_label(color, mark, msg, **kwargs)
+        _print_label(color, mark, msg, flush=True, **kwargs)
 
 
-# Thread for progress animations in indeterminate modes.
+# Get the (mark, message) pairs of a full cycle of the frames of a progress animation in indeterminate modes.
 # We should take care of clearing excessive characters.
-def _progress_print_thread(label, **kwargs):
+def _progress_frames(label, **kwargs):
+    msg = _apply_markup(label.color, str(label.msg), label.sink, kwargs)
+
     if label.mode == PROGRESS_SPIN:
-        spin_gen = itertools.cycle('-\\|/')
+        if kwargs['position'] == 'mark':
+            return [(spin, msg) for spin in '-\\|/']
+        return [(label.mark, msg + spin) for spin in '-\\|/']
     elif label.mode == PROGRESS_EXPAND:
-        dots_gen = itertools.cycle(range(1, kwargs['width'] + 1))
+        return [(label.mark, msg + kwargs['char'] * num) for num in range(1, kwargs['width'] + 1)]
     elif label.mode == PROGRESS_MOVE:
+        frames = []
         direction = True
         buf = kwargs['char'] * kwargs['num'] + ' ' * (kwargs['width'] - kwargs['num'])
-
-    msg = str(label.msg)
-
-    while not label.stopped:
-        if not _main_thread.is_alive():
-            return
-
-        if label.mode == PROGRESS_SPIN:
-            if kwargs['position'] == 'mark':
-                _print_label(label.color, next(spin_gen), msg, newline=False, **kwargs)
-            else:
-                _print_label(label.color, label.mark, msg + next(spin_gen), newline=False, **kwargs)
-        elif label.mode == PROGRESS_EXPAND:
-            _print_label(label.color, label.mark, msg + kwargs['char'] * next(dots_gen), newline=False, **kwargs)
-        elif label.mode == PROGRESS_MOVE:
-            _print_label(label.color, label.mark, msg + '[' + buf + ']', newline=False, **kwargs)
+        start = (buf, direction)
+        while True:
+            frames.append((label.mark, msg + '[' + buf + ']'))
             if direction:
                 buf = buf[-1] + buf[:-1]
             else:
                 buf = buf[1:] + buf[0]
             if kwargs['style'] == 'reflect' and kwargs['char'] in {buf[0], buf[-1]}:
                 direction = not direction
+            if (buf, direction) == start:
+                return frames
+
+
+# Render a full cycle of the frames of a progress animation in indeterminate modes, with header and color codes,
+# so that each tick of the animation only writes the next frame.
+def _render_progress_frames(label, **kwargs):
+    frames = []
+    for mark, msg in _progress_frames(label, **kwargs):
+        template = _get_template(label.color, mark, label.sink, kwargs, newline=False)
+        frames.append(template[0] + msg + template[1])
+    return tuple(frames)
+
+
+# Get the main thread of the interpreter.
+def _get_main_thread():
+    import threading
+    if hasattr(threading, 'main_thread'):
+        return threading.main_thread()
+    for thread in threading.enumerate():  # Python 2
+        if isinstance(thread, threading._MainThread):
+            return thread
+    return threading.current_thread()
+
+
+class _AnimationScheduler(object):
+    """Drives all running animations from a single thread, which is started on demand
+    and exits when there are no more animations.
+
+    An animation is an object with a 'stopped' attribute and a '_tick()' method, which renders a frame
+    and returns the delay (in seconds) before the next frame. Frames are rendered with the scheduler lock held,
+    so an animation can be stopped without racing against its frames by setting 'stopped' under the lock."""
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Condition()
+        self.queue = []  # heap of (due time, sequence number, animation)
+        self.counter = itertools.count()
+        self.thread = None
+        self.main_thread = _get_main_thread()
+
+    def add(self, animation, delay=0):
+        """Start driving an animation, rendering its first frame after the given delay (in seconds)."""
+
+        import heapq
+        import threading
+
+        with self.lock:
+            heapq.heappush(self.queue, (_monotonic() + delay, next(self.counter), animation))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='colorlabels-animation')
+                self.thread.daemon = True
+                self.thread.start()
+            self.lock.notify()
+
+    def stop(self, animation):
+        """Stop an animation. No frame of it will be rendered after this returns."""
+
+        with self.lock:
+            animation.stopped = True
+            self.lock.notify()
+
+    def _run(self):
+        import heapq
+
+        with self.lock:
+            try:
+                while True:
+                    while self.queue and self.queue[0][2].stopped:
+                        heapq.heappop(self.queue)
+
+                    if not self.queue or not self.main_thread.is_alive():
+                        return
+
+                    due, _, animation = self.queue[0]
+                    delay = due - _monotonic()
+                    if delay > 0:
+                        self.lock.wait(delay)
+                        continue
+
+                    heapq.heapreplace(self.queue, (due + animation._tick(), next(self.counter), animation))
+            finally:
+                del self.queue[:]
+                self.thread = None
+
+
+_scheduler = None  # created on first use
+
+
+# Get the animation scheduler.
+def _get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = _AnimationScheduler()
+    return _scheduler
+
+
+# Merge progress settings with the defaults of the progress mode, and check them.
+def _progress_config(mode, kwargs):
+    config = default_progress_config[mode].copy()
+    config.update(kwargs)
+
+    if mode == PROGRESS_SPIN:
+        _check_value_in_list(config['position'], 'position', ('mark', 'tail'))
+        _check_positive_number(config['interval'], 'interval')
+    elif mode == PROGRESS_EXPAND:
+        _check_character(config['char'], 'char')
+        _check_interger_minimum(config['width'], 2, 'width')
+        _check_positive_number(config['interval'], 'interval')
+    elif mode == PROGRESS_MOVE:
+        _check_character(config['char'], 'char')
+        if config['char'] == ' ':
+            raise ValueError("'char' cannot be space")
+        _check_interger_minimum(config['num'], 1, 'num')
+        _check_interger_minimum(config['width'], 2, 'width')
+        if config['num'] >= config['width']:
+            raise ValueError("'num' should be less than 'width'")
+        _check_value_in_list(config['style'], 'style', ('loop', 'reflect'))
+        _check_positive_number(config['interval'], 'interval')
+    elif mode == PROGRESS_DETERMINATE:
+        _check_character(config['char_done'], 'char_done')
+        _check_character(config['char_head'], 'char_head')
+        _check_character(config['char_undone'], 'char_undone')
+        if config['width'] != 'auto':
+            _check_interger_minimum(config['width'], 0, 'width')
+        _check_nonnegative_number(config['min_interval'], 'min_interval')
+        if config['total'] is not None:
+            _check_positive_number(config['total'], 'total')
+        if not isinstance(config['unit'], str):
+            raise TypeError("'unit' should be a string")
+        _check_positive_number(config['smoothing'], 'smoothing')
+        if config['smoothing'] > 1:
+            raise ValueError("'smoothing' should be in range (0, 1]")
+        if config['milestone_step'] is not None:
+            _check_positive_number(config['milestone_step'], 'milestone_step')
+        if config['milestone_interval'] is not None:
+            _check_positive_number(config['milestone_interval'], 'milestone_interval')
+
+    return config
+
+
+# Minimum time (in seconds) between two refreshes of the statistics of a count-based progress label.
+_stats_interval = 0.1
+
+_binary_prefixes = ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi')
+
+
+# Format an amount of the given unit for display, with binary prefixes for bytes.
+def _format_amount(value, unit):
+    if unit != 'B':
+        return ('{} {}' if isinstance(value, int) else '{:.1f} {}').format(value, unit)
+
+    index = 0
+    while abs(value) >= 1024 and index < len(_binary_prefixes) - 1:
+        value /= 1024.0
+        index += 1
+    return ('{:.1f} {}B' if index else '{:.0f} {}B').format(value, _binary_prefixes[index])
+
+
+# Format a duration (in seconds) as minutes and seconds, and hours if needed.
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+    return '{:02}:{:02}'.format(minutes, seconds)
+
+
+class _ProgressStats(object):
+    """Count, elapsed time and rate of a count-based progress.
+    The rate is an exponential moving average of the rates between samples."""
+
+    def __init__(self, total, smoothing):
+        self.total = total
+        self.smoothing = smoothing
+        self.count = 0
+        self.rate = None
+        self.start_time = self.sample_time = _monotonic()
+        self.sample_count = 0
+        self.next_sample_time = self.start_time + _stats_interval
+
+    def sample(self, now):
+        elapsed = now - self.sample_time
+        if elapsed > 0:
+            rate = (self.count - self.sample_count) / elapsed
+            self.rate = rate if self.rate is None else self.smoothing * rate + (1 - self.smoothing) * self.rate
+            self.sample_time = now
+            self.sample_count = self.count
+        self.next_sample_time = now + _stats_interval
+
+    def percent(self):
+        return min(self.count / float(self.total), 1)
+
+    def elapsed(self):
+        return self.sample_time - self.start_time
+
+    # Estimated time (in seconds) to completion, or None if unknown.
+    def eta(self):
+        if not self.rate:
+            return None
+        return max(self.total - self.count, 0) / self.rate
+
+    def format(self, unit):
+        if unit == 'B':
+            text = ' {}/{}'.format(_format_amount(self.count, unit), _format_amount(self.total, unit))
+        else:
+            text = ' {}/{} {}'.format(self.count, self.total, unit)
+
+        if self.count >= self.total:  # show the average rate when done
+            elapsed = self.elapsed()
+            rate = self.count / elapsed if elapsed > 0 else None
+            eta = ''
+        else:
+            rate = self.rate
+            eta = self.eta()
+            eta = ', ETA ' + (_format_duration(eta) if eta is not None else '--:--')
+
+        text += ', ' + (_format_amount(rate, unit) if rate is not None else '? ' + unit) + '/s'
+        return text + ', elapsed ' + _format_duration(self.elapsed()) + eta
+
 
-        time.sleep(kwargs['interval'])
+# Cached number of columns of the terminal, refreshed on SIGWINCH (or every second where it is unavailable).
+_terminal_columns = None
+_terminal_columns_expiry = 0
+_sigwinch_handled = False
 
-    _progress_final(label.color, label.mark, msg, **kwargs)
+
+# Handle SIGWINCH by dropping the cached terminal size, and chain to the previous handler.
+def _make_sigwinch_handler(previous):
+    def handler(signum, frame):
+        global _terminal_columns
+        _terminal_columns = None
+        if callable(previous):
+            previous(signum, frame)
+    return handler
+
+
+# Start watching for terminal size changes, and return whether it succeeded.
+def _watch_terminal_size():
+    import signal
+
+    if not hasattr(signal, 'SIGWINCH'):  # Windows
+        return False
+    try:
+        signal.signal(signal.SIGWINCH, _make_sigwinch_handler(signal.getsignal(signal.SIGWINCH)))
+    except ValueError:  # not called from the main thread
+        return False
+    return True
+
+
+# Get the number of columns of the terminal.
+def _get_terminal_columns():
+    global _terminal_columns, _terminal_columns_expiry, _sigwinch_handled
+
+    if _terminal_columns is None or (not _sigwinch_handled and _monotonic() >= _terminal_columns_expiry):
+        if not _sigwinch_handled:
+            _sigwinch_handled = _watch_terminal_size()
+        try:
+            import shutil
+            columns = shutil.get_terminal_size().columns
+        except AttributeError:  # Python 2
+            columns = int(os.getenv('COLUMNS', '80'))
+        _terminal_columns = columns if columns > 0 else 80
+        _terminal_columns_expiry = _monotonic() + 1
+
+    return _terminal_columns
+
+
+# Split a string into (text, is_escape) tokens, where escape tokens are ANSI escape sequences like '\033[31m'.
+def _split_escapes(s):
+    pieces = s.split('\033')
+    tokens = [(pieces[0], False)] if pieces[0] else []
+    for piece in pieces[1:]:
+        end = 1
+        if piece.startswith('['):  # CSI sequence, ended by a character in range '@' to '~'
+            while end < len(piece) and not '@' <= piece[end] <= '~':
+                end += 1
+            end += 1
+        elif piece.startswith(']'):  # OSC sequence (e.g. setting the window title), ended by BEL
+            end = piece.find('\007') + 1 or len(piece)
+        tokens.append(('\033' + piece[:end], True))
+        if piece[end:]:
+            tokens.append((piece[end:], False))
+    return tokens
+
+
+# Lookup table of the widths of non-ASCII characters, filled on first use of each character.
+_char_widths = {}
+_max_char_widths = 4096
+
+
+# Get the number of columns a character takes up: 2 for East Asian wide and fullwidth characters,
+# 0 for combining marks and control or format characters (e.g. zero-width joiner), and 1 otherwise.
+def _char_width(char):
+    try:
+        return _char_widths[char]
+    except KeyError:
+        import unicodedata
+
+        if unicodedata.combining(char) or unicodedata.category(char) in {'Mn', 'Me', 'Cc', 'Cf'}:
+            width = 0
+        elif unicodedata.east_asian_width(char) in {'W', 'F'}:
+            width = 2
+        else:
+            width = 1
+        if len(_char_widths) >= _max_char_widths:
+            _char_widths.clear()
+        _char_widths[char] = width
+        return width
+
+
+# Check whether a string is made of ASCII characters only (in constant time on Python 3.7+).
+if hasattr(str, 'isascii'):
+    _is_ascii = str.isascii
+else:
+    def _is_ascii(s):
+        return not s or max(s) < u'\x80'
+
+
+# Get the number of columns a string without escape sequences takes up.
+def _plain_width(text):
+    if _is_ascii(text):
+        return len(text)
+    return sum([_char_width(char) for char in text])
+
+
+# Least recently used cache of the widths of strings with escape sequences or non-ASCII characters.
+_text_widths = {}
+_max_text_widths = 1024
+
+
+# Get the number of columns a string with escape sequences takes up.
+def _escaped_width(s):
+    return sum([_plain_width(token) for token, is_escape in _split_escapes(s) if not is_escape])
+
+
+# Get the width of the header of a label (including the following space), with per-call settings in kwargs.
+def _header_width(mark, kwargs):
+    if not _layered_choice(kwargs.get('show_header'), _current_style().show_header):
+        return 0
+    return text_width(header_pattern.format(mark=mark)) + 1
+
+
+# Lay out the progress bar of a determinate progress label, given the header width, message and text.
+# Return the width of the bar and the number of characters representing done percentage.
+# In auto width mode, the bar takes up the room left on the terminal line.
+def _bar_layout(config, header_width, msg, text, percent):
+    num_total = config['width']
+    if num_total == 'auto':
+        used = header_width + text_width(msg) + text_width(text)
+        num_total = max(0, _get_terminal_columns() - 1 - used - 2)  # leave the last column to avoid wrapping
+    return num_total, int(round(num_total * percent))
+
+
+# Truncate the content of a determinate progress label to fit the terminal line in auto width mode,
+# so that the line does not wrap and can be cleared.
+def _fit_content(config, header_width, content):
+    if config['width'] != 'auto':
+        return content
+    return truncate(content, max(0, _get_terminal_columns() - 1 - header_width))
+
+
+# Render the progress bar of a determinate progress label.
+def _render_bar(config, layout):
+    num_total, num_done = layout
+    if not num_total:
+        return ''
+
+    if num_done < num_total:
+        bar = config['char_done'] * num_done + config['char_head'] + config['char_undone'] * (num_total - num_done - 1)
+    else:
+        bar = config['char_done'] * num_total
+
+    return '[' + bar + ']'
 
 
 class ProgressLabel:
     def __init__(self, mode, color, mark, msg, **kwargs):
-        config = default_progress_config[mode].copy()
-        config.update(kwargs)
-
-        if mode == PROGRESS_SPIN:
-            _check_value_in_list(config['position'], 'position', ('mark', 'tail'))
-            _check_positive_number(config['interval'], 'interval')
-        elif mode == PROGRESS_EXPAND:
-            _check_character(config['char'], 'char')
-            _check_interger_minimum(config['width'], 2, 'width')
-            _check_positive_number(config['interval'], 'interval')
-        elif mode == PROGRESS_MOVE:
-            _check_character(config['char'], 'char')
-            if config['char'] == ' ':
-                raise ValueError("'char' cannot be space")
-            _check_interger_minimum(config['num'], 1, 'num')
-            _check_interger_minimum(config['width'], 2, 'width')
-            if config['num'] >= config['width']:
-                raise ValueError("'num' should be less than 'width'")
-            _check_value_in_list(config['style'], 'style', ('loop', 'reflect'))
-            _check_positive_number(config['interval'], 'interval')
-        elif mode == PROGRESS_DETERMINATE:
-            _check_character(config['char_done'], 'char_done')
-            _check_character(config['char_head'], 'char_head')
-            _check_character(config['char_undone'], 'char_undone')
-            _check_interger_minimum(config['width'], 0, 'width')
+        config = _progress_config(mode, kwargs)
 
         self.mode = mode
         self.color = color
         self.mark = mark
         self.msg = msg
-
-        if not is_tty:
-            # Fall back to a static label if not in a tty.
+        self.sink = config['file'] = _get_sink(config.get('file'))
+        self.interactive = _interactive(self.sink)
+        self.config = config
+        self.stats = None
+        if mode == PROGRESS_DETERMINATE and config['total'] is not None:
+            self.stats = _ProgressStats(config['total'], config['smoothing'])
+            self.advance_text = ''
+
+        if not self.interactive:
+            # Fall back to a static label if not in a tty, followed by milestone lines in determinate mode.
             _print_label(color, mark, msg, **config)
+            self.last_percent = None
+            if mode == PROGRESS_DETERMINATE:
+                self.start_time = _monotonic()
+                self.next_milestone = config['milestone_step']
+                self.next_milestone_time = self.start_time + (config['milestone_interval'] or 0)
+                self.unreported = None
+                self.reported_percent = None
             return
 
         if mode in {PROGRESS_SPIN, PROGRESS_EXPAND, PROGRESS_MOVE}:
-            self.print_thread = threading.Thread(target=_progress_print_thread, args=(self,), kwargs=config)
+            self.frames = _render_progress_frames(self, **config)
+            self.frame_index = 0
             self.stopped = False
-            self.print_thread.start()
+            self._start_animation()
         elif mode == PROGRESS_DETERMINATE:
-            self.config = config
-            self.update(0)
+            self.display_msg = _apply_markup(color, str(msg), self.sink, config)  # message rendered once
+            self.header_width = _header_width(mark, config)
+            self.layout = self.text = None  # last update, which may not be rendered yet
+            self.pending = False
+            self.last_render_time = 0
+            self.update(0, self.stats.format(config['unit']) if self.stats else '')
+
+    def _start_animation(self):
+        self.scheduler = _get_scheduler()
+        self.scheduler.add(self)
+
+    # Stop the animation, and return whether it was running.
+    def _stop_animation(self):
+        with self.scheduler.lock:
+            if self.stopped:
+                return False
+            self.scheduler.stop(self)
+            return True
+
+    def _tick(self):
+        self.frame = self.frames[self.frame_index]
+        self.frame_index = (self.frame_index + 1) % len(self.frames)
+        self.sink.write(self.frame, live=self, label_type='progress')
+        return self.config['interval']
+
+    def _live_clear(self):
+        return CLEAR_LINE
+
+    def _live_redraw(self):
+        return self.frame
 
     def __enter__(self):
         return self
@@ -403,44 +1760,809 @@ class ProgressLabel:
         if not isinstance(text, str):
             raise TypeError("'text' should be a string")
 
-        if not is_tty:
+        if not self.interactive:
+            if _output_format == 'json':
+                self._json_update(percent, text)
+            else:
+                self._milestone_update(percent, text)
             return
 
-        num_total = self.config['width']
-        if num_total:
-            num_done = int(round(num_total * percent))
-            if num_done < num_total:
-                bar = self.config['char_done'] * num_done + self.config['char_head'] + \
-                      self.config['char_undone'] * (num_total - num_done - 1)
-            else:
-                bar = self.config['char_done'] * num_total
+        # Skip updates which do not change the label, and delay those coming too fast.
+        layout = _bar_layout(self.config, self.header_width, self.display_msg, text, percent)
+        if layout == self.layout and text == self.text:
+            return
 
-            bar = '[' + bar + ']'
-        else:
-            bar = ''
+        self.layout = layout
+        self.text = text
+        if _monotonic() - self.last_render_time < self.config['min_interval']:
+            self.pending = True
+            return
+
+        self._render()
 
-        msg = str(self.msg)
-        _print_label(self.color, self.mark, msg + bar + text, newline=False, **self.config)
+    def advance(self, n=1, text=''):
+        """Advance the count of a determinate progress label created with 'total' by n items (or bytes).
+        The count, smoothed rate, elapsed time and ETA are displayed before the additional text,
+        and refreshed at most every 0.1 seconds."""
+
+        stats = self.stats
+        if stats is None:
+            raise TypeError("cannot advance progress without 'total'")
+
+        stats.count += n
+        self.advance_text = text
+        now = _monotonic()
+        if now < stats.next_sample_time and stats.count < stats.total:
+            return
+
+        stats.sample(now)
+        self.update(stats.percent(), stats.format(self.config['unit']) + text)
+
+    # Write a JSON record of the progress whenever the rounded percentage changes.
+    def _json_update(self, percent, text):
+        rounded = int(percent * 100)
+        if rounded == self.last_percent:
+            return
+
+        self.last_percent = rounded
+        template = _get_template(self.color, self.mark, self.sink, self.config)
+        extra = ',"percent":' + repr(round(percent, 4)) + ',"text":' + _json_string(text)
+        if self.stats:
+            rate = self.stats.rate
+            extra += ',"count":{!r},"total":{!r},"rate":{}'.format(
+                self.stats.count, self.stats.total, 'null' if rate is None else repr(round(rate, 3)))
+        self.sink.write(_json_record(template, self.msg, _json_timestamp(), extra), label_type='progress')
+
+    # Write a milestone line of the progress whenever a percentage step is reached or an interval has passed.
+    def _milestone_update(self, percent, text, force=False):
+        config = self.config
+        step = config['milestone_step']
+        interval = config['milestone_interval']
+        now = _monotonic()
+        if not (force or step and percent * 100 >= self.next_milestone or interval and now >= self.next_milestone_time):
+            self.unreported = (percent, text)
+            return
+
+        if step:
+            self.next_milestone = (int(percent * 100 / step) + 1) * step
+        if interval:
+            self.next_milestone_time = now + interval
+        self.unreported = None
+        self.reported_percent = percent
+
+        line = '{}{}%'.format(self.msg, int(percent * 100))
+        if self.stats is None:
+            # Estimate the time to completion from the average progress so far.
+            elapsed = now - self.start_time
+            line += ', elapsed ' + _format_duration(elapsed)
+            if percent < 1:
+                line += ', ETA ' + (_format_duration(elapsed * (1 - percent) / percent) if percent > 0 else '--:--')
+        _print_label(self.color, self.mark, line + text, **config)
+
+    def _render(self):
+        self.pending = False
+        self.last_render_time = _monotonic()
+        content = self.display_msg + _render_bar(self.config, self.layout) + self.text
+        content = _fit_content(self.config, self.header_width, content)
+        template = _get_template(self.color, self.mark, self.sink, self.config, newline=False)
+        self.frame = template[0] + content + template[1]
+        self.sink.write(self.frame, live=self, label_type='progress')
 
     def stop(self):
         """Stop progress animation."""
 
-        if not is_tty:
+        if not self.interactive:
+            config = self.config
+            if self.mode == PROGRESS_DETERMINATE and _output_format != 'json' and (
+                    config['milestone_step'] or config['milestone_interval']):
+                if self.stats and self.stats.count != self.stats.sample_count:
+                    self.stats.sample(_monotonic())  # Report the final count and elapsed time.
+                    self.unreported = (self.stats.percent(), self.stats.format(config['unit']) + self.advance_text)
+                if self.unreported is not None and self.unreported[0] != self.reported_percent:
+                    self._milestone_update(*self.unreported, force=True)  # Report the final progress.
             return
 
         if self.mode in {PROGRESS_SPIN, PROGRESS_EXPAND, PROGRESS_MOVE}:
-            if not self.stopped:
-                self.stopped = True
-                self.print_thread.join()
+            if self._stop_animation():
+                self.sink.end_live(self)
+                _progress_final(self.color, self.mark, self.msg, **self.config)
         elif self.mode == PROGRESS_DETERMINATE:
+            if self.stats:
+                self.stats.sample(_monotonic())  # Display the final count and elapsed time.
+                self.update(self.stats.percent(), self.stats.format(self.config['unit']) + self.advance_text)
+            if self.pending:
+                self._render()  # Ensure the last update is displayed.
+            self.sink.end_live(self)
             if not self.config['erase'] and not self.config['cleanup']:
-                _inline_write('\n')
+                self.sink.write('\n', flush=True, label_type='progress')
             else:
                 _progress_final(self.color, self.mark, self.msg, **self.config)
 
 
+# Get the running asyncio event loop.
+def _get_running_loop():
+    import asyncio
+    get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+    return get_loop()
+
+
+# Get an awaitable which immediately returns the given value.
+def _completed_future(loop, value=None):
+    future = loop.create_future()
+    future.set_result(value)
+    return future
+
+
+class AsyncProgressLabel(ProgressLabel):
+    """A progress label whose animation is driven by the running asyncio event loop instead of a thread.
+    It should only be used and stopped from the event loop thread."""
+
+    def __init__(self, mode, color, mark, msg, **kwargs):
+        self.loop = _get_running_loop()
+        self.handle = None
+        ProgressLabel.__init__(self, mode, color, mark, msg, **kwargs)
+
+    def _start_animation(self):
+        self.handle = self.loop.call_soon(self._run_tick)
+
+    def _stop_animation(self):
+        if self.stopped:
+            return False
+        self.stopped = True
+        self.handle.cancel()
+        return True
+
+    def _run_tick(self):
+        if not self.stopped:
+            self.handle = self.loop.call_later(self._tick(), self._run_tick)
+
+    def __aenter__(self):
+        return _completed_future(self.loop, self)
+
+    def __aexit__(self, type_, value, traceback):
+        self.stop()
+        return _completed_future(self.loop, False)
+
+
+class ProgressGroupBar(object):
+    """A determinate progress bar displayed on its own line in a progress group."""
+
+    def __init__(self, group, index, color, mark, msg, config):
+        self.group = group
+        self.index = index
+        self.msg = msg
+        self.config = config
+        self.template = _get_template(color, mark, group.sink, config, newline=False, clear_line=False)
+        self.display_msg = _apply_markup(color, str(msg), group.sink, config)  # message rendered once
+        self.header_width = _header_width(mark, config)
+        self.layout = self.text = None
+        self.stopped = False
+
+    def _render(self, percent, text):
+        msg = self.display_msg
+        layout = _bar_layout(self.config, self.header_width, msg, text, percent)
+        if layout == self.layout and text == self.text:
+            return None
+
+        self.layout = layout
+        self.text = text
+        content = _fit_content(self.config, self.header_width, msg + _render_bar(self.config, layout) + text)
+        return self.template[0] + content + self.template[1]
+
+    def update(self, percent, text=''):
+        """Update progress to the given percentage.
+        You can provide additional text to describe current status."""
+
+        _check_percent(percent, 'percent')
+
+        if not isinstance(text, str):
+            raise TypeError("'text' should be a string")
+
+        if not self.group.interactive or self.stopped:
+            return
+
+        line = self._render(percent, text)
+        if line is not None:
+            self.group._set_line(self.index, line)
+
+    def stop(self, percent=None, text=''):
+        """Stop updating the progress bar. The final line is displayed according to the
+        'cleanup' and 'erase' settings, or otherwise shows the given percentage and text if present."""
+
+        if not self.group.interactive or self.stopped:
+            return
+
+        if self.config['erase']:
+            line = ''
+        elif self.config['cleanup']:
+            line = self.template[0] + self.display_msg + self.template[1]
+        elif percent is not None:
+            _check_percent(percent, 'percent')
+            line = self._render(percent, text)
+        else:
+            line = None
+
+        self.stopped = True
+        if line is not None:
+            self.group._set_line(self.index, line)
+
+
+class ProgressGroup(object):
+    """Multiple determinate progress bars displayed on consecutive lines.
+
+    Updates of the bars only mark their lines as changed. The changed lines are redrawn together
+    every 'interval' seconds in a single write, by moving the cursor within the block of lines."""
+
+    def __init__(self, interval=0.1, file=None):
+        import threading
+
+        _check_positive_number(interval, 'interval')
+
+        self.interval = interval
+        self.sink = _get_sink(file)
+        self.interactive = _interactive(self.sink)
+        self.lock = threading.Lock()
+        self.bars = []
+        self.lines = []  # latest rendered line of each bar
+        self.changed = set()  # indices of lines to redraw
+        self.num_drawn = 0  # number of lines already on the screen, the cursor stays below them
+        self.stopped = False
+
+        if self.interactive:
+            self.scheduler = _get_scheduler()
+            self.scheduler.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.stop()
+
+    def add(self, msg, **kwargs):
+        """Add a progress bar containing the given message to the group, and return it."""
+
+        color, mark = _get_color_and_mark('progress', kwargs)
+        kwargs.pop('file', None)
+        config = _progress_config(PROGRESS_DETERMINATE, kwargs)
+
+        with self.lock:
+            bar = ProgressGroupBar(self, len(self.bars), color, mark, msg, config)
+            self.bars.append(bar)
+            self.lines.append('')
+            self.changed.add(bar.index)
+
+        if not self.interactive:
+            # Fall back to a static label if not in a tty.
+            _print_label(color, mark, msg, file=self.sink, **config)
+        else:
+            bar.update(0)
+
+        return bar
+
+    def _set_line(self, index, line):
+        with self.lock:
+            if self.lines[index] != line:
+                self.lines[index] = line
+                self.changed.add(index)
+
+    def _live_clear(self):
+        if not self.num_drawn:
+            return '\r'
+        return '\033[{}A'.format(self.num_drawn) + '\r\033[J'  # move to the first line, and clear to the end
+
+    def _live_redraw(self):
+        with self.lock:
+            return ''.join(CLEAR_LINE + line + '\n' for line in self.lines[:self.num_drawn])
+
+    def _redraw(self):
+        with self.sink.lock:
+            self._redraw_changed()
+
+    def _redraw_changed(self):
+        with self.lock:
+            if not self.changed:
+                return
+            changed = sorted(self.changed)
+            self.changed.clear()
+            lines = [self.lines[index] for index in changed]
+
+        out = []
+        row = self.num_drawn
+        for index, line in zip(changed, lines):
+            if index < self.num_drawn:  # move to an existing line and overwrite it
+                if index < row:
+                    out.append('\033[{}A'.format(row - index))
+                elif index > row:
+                    out.append('\033[{}B'.format(index - row))
+                out.append(CLEAR_LINE + line)
+                row = index
+            else:  # go back below the block and append a new line
+                if row < self.num_drawn:
+                    out.append('\033[{}B'.format(self.num_drawn - row) + '\r')
+                    row = self.num_drawn
+                out.append(CLEAR_LINE + line + '\n')
+                row = self.num_drawn = index + 1
+
+        if row < self.num_drawn:
+            out.append('\033[{}B'.format(self.num_drawn - row) + '\r')
+
+        self.sink.write(''.join(out), live=self, label_type='progress')
+
+    def _tick(self):
+        self._redraw()
+        return self.interval
+
+    def stop(self):
+        """Stop all progress bars and display their final lines."""
+
+        if not self.interactive:
+            return
+
+        with self.scheduler.lock:
+            if not self.stopped:
+                self.scheduler.stop(self)
+                for bar in self.bars:
+                    bar.stop()
+                self._redraw()
+                self.sink.end_live(self)
+
+
+class QueueStream(object):
+    """A file-like object putting all text written to it into a queue.
+
+    Use it as the output stream of labels in worker processes, with a QueueListener in the parent process
+    to write them out. The tty mode of the parent process is used by default."""
+
+    def __init__(self, queue, tty=None):
+        self.queue = queue
+        self.tty = _stdout_tty() if tty is None else bool(tty)
+
+    def write(self, s):
+        self.queue.put(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+
+class QueueListener(object):
+    """Write out label output received from a queue (e.g. sent by QueueStream objects in worker processes)
+    with a background thread, so that output of all processes goes through a single writer."""
+
+    def __init__(self, queue, file=None):
+        self.queue = queue
+        self.sink = _get_sink(file)
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.stop()
+
+    def _run(self):
+        while True:
+            s = self.queue.get()
+            if s is None:
+                break
+            self.sink.write(s)
+
+    def start(self):
+        """Start writing out output received from the queue."""
+
+        import threading
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='colorlabels-queue-listener')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Write out all output already sent to the queue, and stop."""
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.sink.flush()
+
+
+# Binary format of recordings: a header, then records made of (seconds since the start, label type code,
+# length of text) packed in _record_struct, followed by the text of the output encoded in UTF-8.
+_recording_header = b'CLREC\x01\n'
+_record_types = (None,) + all_labels  # label types by code, None for other output (e.g. newlines)
+_record_type_codes = dict((label_type, code) for code, label_type in enumerate(_record_types))
+_record_struct = None  # created on first use
+
+
+# Get the packing format of record headers.
+def _get_record_struct():
+    global _record_struct
+    if _record_struct is None:
+        import struct
+        _record_struct = struct.Struct('<dBI')
+    return _record_struct
+
+
+# Parse packed records into (time, label type, text) tuples.
+def _parse_records(data, offset=0):
+    record_struct = _get_record_struct()
+    records = []
+    while offset + record_struct.size <= len(data):
+        timestamp, code, length = record_struct.unpack_from(data, offset)
+        offset += record_struct.size
+        text = data[offset:offset + length].decode('utf-8', 'replace')
+        offset += length
+        records.append((timestamp, _record_types[code] if code < len(_record_types) else None, text))
+    return records
+
+
+class Recorder(object):
+    """Record all label output, including progress animation frames, with timestamps and label types.
+
+    Records are kept in a ring buffer in memory, dropping the oldest records beyond 'size' bytes,
+    or appended to a binary file if 'path' is given. Only one recorder can be active at a time."""
+
+    def __init__(self, path=None, size=1048576):
+        import collections
+        import threading
+
+        _check_interger_minimum(size, 1, 'size')
+
+        self.path = path
+        self.size = size
+        self.buffer = collections.deque()  # packed records
+        self.length = 0  # total size of packed records in the buffer
+        self.file = None
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.record_struct = _get_record_struct()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.stop()
+
+    def _record(self, label_type, s):
+        data = s if isinstance(s, bytes) else s.encode('utf-8', 'replace')
+        record = self.record_struct.pack(_monotonic() - self.start_time, _record_type_codes.get(label_type, 0),
+                                         len(data)) + data
+
+        with self.lock:
+            if self.path is not None:
+                if self.file is not None:
+                    self.file.write(record)
+                return
+
+            self.buffer.append(record)
+            self.length += len(record)
+            while self.length > self.size:
+                self.length -= len(self.buffer.popleft())
+
+    def start(self):
+        """Start recording label output."""
+
+        global _recorder
+
+        if _recorder is not None:
+            if _recorder is self:
+                return
+            raise RuntimeError('another recorder is active')
+
+        self.start_time = _monotonic()
+        if self.path is not None:
+            self.file = open(self.path, 'wb')
+            self.file.write(_recording_header)
+        _recorder = self
+
+    def stop(self):
+        """Stop recording label output, and close the file of records if any."""
+
+        global _recorder
+
+        if _recorder is self:
+            _recorder = None
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def records(self):
+        """Return the records in memory as a list of (time, label type, text) tuples,
+        where time is the number of seconds since the recording started."""
+
+        with self.lock:
+            data = b''.join(self.buffer)
+        return _parse_records(data)
+
+    def save(self, path):
+        """Save the records in memory to a file, which can be loaded with load_recording()."""
+
+        with self.lock:
+            data = b''.join(self.buffer)
+        with open(path, 'wb') as f:
+            f.write(_recording_header)
+            f.write(data)
+
+
+# Get the records of a recording given as a file path, a Recorder or a list of records.
+def _recording_records(recording):
+    if isinstance(recording, str):
+        return load_recording(recording)
+    if isinstance(recording, Recorder):
+        return recording.records()
+    return recording
+
+
+# Style of a character cell on the screen: (foreground RGB, background RGB, bold, dim, underline).
+_plain_cell_style = (None, None, False, False, False)
+
+
+# Apply the parameters of an SGR sequence to the style of character cells.
+def _apply_sgr(style, params):
+    foreground, background, bold, dim, underline = style
+    i = 0
+    while i < len(params):
+        param = params[i]
+        if param == 0:
+            foreground, background, bold, dim, underline = _plain_cell_style
+        elif param in {1, 2, 4}:
+            bold, dim, underline = bold or param == 1, dim or param == 2, underline or param == 4
+        elif param == 22:
+            bold = dim = False
+        elif param == 24:
+            underline = False
+        elif 30 <= param <= 37 or 90 <= param <= 97:
+            foreground = _standard_colors[param - 30 if param < 90 else param - 82]
+        elif 40 <= param <= 47 or 100 <= param <= 107:
+            background = _standard_colors[param - 40 if param < 100 else param - 92]
+        elif param == 39:
+            foreground = None
+        elif param == 49:
+            background = None
+        elif param in {38, 48} and i + 1 < len(params):
+            color = None
+            if params[i + 1] == 5 and i + 2 < len(params):
+                color = _color256_to_rgb(min(params[i + 2], 255))
+                i += 2
+            elif params[i + 1] == 2 and i + 4 < len(params):
+                color = tuple(min(component, 255) for component in params[i + 2:i + 5])
+                i += 4
+            if param == 38:
+                foreground = color
+            else:
+                background = color
+        i += 1
+    return foreground, background, bold, dim, underline
+
+
+# Get the CSS declarations of the style of character cells.
+def _css_style(style):
+    foreground, background, bold, dim, underline = style
+    css = []
+    if foreground is not None:
+        css.append('color:#{:02x}{:02x}{:02x}'.format(*foreground))
+    if background is not None:
+        css.append('background-color:#{:02x}{:02x}{:02x}'.format(*background))
+    if bold:
+        css.append('font-weight:bold')
+    if dim:
+        css.append('opacity:0.6')
+    if underline:
+        css.append('text-decoration:underline')
+    return ';'.join(css)
+
+
+# Escape text for HTML.
+def _html_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+class _Screen(object):
+    """A minimal terminal emulator for label output, used to convert recordings. It supports colors and styles,
+    carriage returns, erasing lines and moving the cursor vertically, which is all that labels and progress
+    animations use."""
+
+    def __init__(self):
+        self.lines = [[]]  # rows of (character, style) cells
+        self.row = self.col = 0
+        self.style = _plain_cell_style
+
+    def _move_to_row(self, row):
+        self.row = max(0, row)
+        while len(self.lines) <= self.row:
+            self.lines.append([])
+
+    def _put(self, char):
+        line = self.lines[self.row]
+        if self.col > len(line):
+            line.extend([(' ', _plain_cell_style)] * (self.col - len(line)))
+        if self.col == len(line):
+            line.append((char, self.style))
+        else:
+            line[self.col] = (char, self.style)
+        self.col += 1
+
+    def _escape(self, sequence):
+        if not sequence.startswith('\033[') or len(sequence) < 3:
+            return  # not a CSI sequence
+        command = sequence[-1]
+        params = [int(param) if param.isdigit() else 0 for param in sequence[2:-1].split(';')]
+        line = self.lines[self.row]
+
+        if command == 'm':
+            self.style = _apply_sgr(self.style, params)
+        elif command == 'K':
+            if params[0] == 0:
+                del line[self.col:]
+            elif params[0] == 1:
+                line[:self.col + 1] = [(' ', _plain_cell_style)] * min(self.col + 1, len(line))
+            else:
+                del line[:]
+        elif command == 'J':
+            if params[0] == 0:
+                del line[self.col:]
+                del self.lines[self.row + 1:]
+            else:
+                self.lines = [[] for _ in self.lines]
+        elif command == 'A':
+            self._move_to_row(self.row - (params[0] or 1))
+        elif command == 'B':
+            self._move_to_row(self.row + (params[0] or 1))
+        elif command == 'C':
+            self.col += params[0] or 1
+        elif command == 'D':
+            self.col = max(0, self.col - (params[0] or 1))
+
+    def feed(self, text):
+        for token, is_escape in _split_escapes(text):
+            if is_escape:
+                self._escape(token)
+                continue
+            for char in token:
+                if char == '\n':
+                    self._move_to_row(self.row + 1)
+                    self.col = 0
+                elif char == '\r':
+                    self.col = 0
+                elif char == '\b':
+                    self.col = max(0, self.col - 1)
+                elif char >= ' ' or char == '\t':
+                    self._put(char)
+
+    # Get the rows of the screen, without trailing empty rows.
+    def _rows(self):
+        rows = list(self.lines)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def text(self):
+        return ''.join([''.join([char for char, style in row]).rstrip() + '\n' for row in self._rows()])
+
+    def html(self):
+        out = ['<pre class="colorlabels">']
+        for row in self._rows():
+            for style, cells in itertools.groupby(row, key=lambda cell: cell[1]):
+                text = _html_escape(''.join([char for char, _ in cells]))
+                css = _css_style(style)
+                out.append('<span style="{}">{}</span>'.format(css, text) if css else text)
+            out.append('\n')
+        out.append('</pre>\n')
+        return ''.join(out)
+
+
+# Label types for logging levels, from the highest level to the lowest.
+_logging_label_types = ((40, 'error'), (30, 'warning'), (20, 'info'), (0, 'plain'))
+
+
+# Define the logging handler and formatter classes, importing logging on first use.
+def _make_logging_classes():
+    global LabelHandler, LabelFormatter
+
+    if 'LabelHandler' in globals():
+        return {'LabelHandler': LabelHandler, 'LabelFormatter': LabelFormatter}
+
+    import logging
+
+    class LabelFormatter(logging.Formatter):
+        """A logging formatter producing the messages of labels, and choosing the label type of log records.
+        Level names are not included by default, since the label mark already shows them."""
+
+        def label_type(self, record):
+            """Return the label type for a log record: 'error' for ERROR and CRITICAL, 'warning' for WARNING,
+            'info' for INFO and 'plain' for lower levels."""
+
+            for level, label_type in _logging_label_types:
+                if record.levelno >= level:
+                    return label_type
+            return 'plain'
+
+    class LabelHandler(logging.Handler):
+        """A logging handler displaying log records as labels.
+
+        Labels use the runtime global settings of colors and marks, with templates compiled once per label type.
+        If blocking is False, records are formatted by the logging thread and written by a background thread,
+        so logging calls never wait for terminal I/O."""
+
+        def __init__(self, level=logging.NOTSET, file=None, blocking=True):
+            logging.Handler.__init__(self, level)
+            self.setFormatter(LabelFormatter())
+            self.file = file
+            self.queue = None
+            self.thread = None
+
+            if not blocking:
+                import threading
+                try:
+                    import queue
+                except ImportError:  # Python 2
+                    import Queue as queue
+
+                self.queue = queue.Queue()
+                self.thread = threading.Thread(target=self._run, name='colorlabels-logging')
+                self.thread.daemon = True
+                self.thread.start()
+
+        def setFormatter(self, fmt):
+            if not isinstance(fmt, LabelFormatter):
+                raise TypeError("'fmt' should be a LabelFormatter")
+            logging.Handler.setFormatter(self, fmt)
+
+        def _write(self, label_type, msg):
+            sink = _get_sink(self.file)
+            _write_label(sink, _get_type_template(label_type, sink, _current_style()), msg, label_type=label_type)
+
+        def _run(self):
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is None:
+                        return
+                    self._write(*item)
+                except Exception:
+                    pass  # the record has already left logging, there is nobody to report the error to
+                finally:
+                    self.queue.task_done()
+
+        def emit(self, record):
+            try:
+                msg = self.format(record)
+                label_type = self.formatter.label_type(record)
+                if self.queue is None:
+                    self._write(label_type, msg)
+                else:
+                    self.queue.put((label_type, msg))
+            except Exception:
+                self.handleError(record)
+
+        def flush(self):
+            if self.queue is not None:
+                self.queue.join()
+            _get_sink(self.file).flush()
+
+        def close(self):
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+            logging.Handler.close(self)
+
+    return {'LabelHandler': LabelHandler, 'LabelFormatter': LabelFormatter}
+
+
 # Public functions that users are supposed to call.
 
+# Settings which can be configured in a scope with configured().
+_scoped_settings = frozenset(['color_span', 'show_header', 'markup'] + [label + '_color' for label in all_labels] +
+                             [label + '_mark' for label in all_labels])
+
+
 def config(**kwargs):
     """Set up runtime global settings."""
 
@@ -456,6 +2578,60 @@ def config(**kwargs):
         global custom_show_header
         custom_show_header = bool(kwargs['show_header'])
 
+    # Inline markup configuration.
+    if 'markup' in kwargs:
+        global custom_markup
+        custom_markup = bool(kwargs['markup'])
+
+    # Output flushing configuration.
+    global custom_flush_mode, custom_flush_interval, custom_buffer_size
+    global _flush_mode, _flush_interval, _buffer_size, _atexit_registered
+    if 'flush' in kwargs:
+        _check_flush_mode(kwargs['flush'])
+        custom_flush_mode = kwargs['flush']
+    if 'flush_interval' in kwargs:
+        _check_positive_number(kwargs['flush_interval'], 'flush_interval')
+        custom_flush_interval = kwargs['flush_interval']
+    if 'buffer_size' in kwargs:
+        _check_interger_minimum(kwargs['buffer_size'], 1, 'buffer_size')
+        custom_buffer_size = kwargs['buffer_size']
+
+    # Output stream configuration.
+    if 'stream' in kwargs:
+        _check_stream(kwargs['stream'], 'stream')
+        global custom_stream
+        custom_stream = kwargs['stream']
+
+    # Repeated labels configuration.
+    global custom_dedup, custom_rate_limit, _suppressor
+    if 'dedup' in kwargs:
+        custom_dedup = bool(kwargs['dedup'])
+    if 'rate_limit' in kwargs:
+        _check_rate_limit(kwargs['rate_limit'])
+        custom_rate_limit = kwargs['rate_limit']
+    if 'dedup' in kwargs or 'rate_limit' in kwargs:
+        if _suppressor is not None:
+            _suppressor.finish()
+        dedup = _layered_choice(custom_dedup, default_dedup)
+        rate_limit = _layered_choice(custom_rate_limit, default_rate_limit)
+        _suppressor = _Suppressor(dedup, rate_limit) if dedup or rate_limit is not None else None
+
+    # Output format configuration.
+    global custom_format, _output_format
+    if 'format' in kwargs:
+        _check_format(kwargs['format'])
+        custom_format = kwargs['format']
+    _output_format = _layered_choice(custom_format, default_format)
+
+    _flush_mode = _layered_choice(custom_flush_mode, default_flush_mode)
+    _flush_interval = _layered_choice(custom_flush_interval, default_flush_interval)
+    _buffer_size = _layered_choice(custom_buffer_size, default_buffer_size)
+    if _flush_mode == 'line' and _suppressor is None:
+        _flush_all()  # Do not leave output pending when switching back to line mode.
+    elif not _atexit_registered:
+        atexit.register(_flush_all_at_exit)
+        _atexit_registered = True
+
     # Label colors configuration.
     for label in all_labels:
         _check_str_and_config_if_present(label + '_color', kwargs, custom_colors, label)
@@ -464,16 +2640,62 @@ def config(**kwargs):
     for label in all_labels:
         _check_str_and_config_if_present(label + '_mark', kwargs, custom_marks, label)
 
+    # Compiled label templates depend on the settings above.
+    global _style_version, _global_style
+    _label_templates.clear()
+    _json_templates.clear()
+    _style_version += 1
+    _global_style = _Style(_style_version, {})
+
+
+def configured(**kwargs):
+    """Return a context manager applying label settings within its scope, in the current thread or asyncio task."""
+
+    for key, value in kwargs.items():
+        if key not in _scoped_settings:
+            raise ValueError('{!r} cannot be configured in a scope'.format(key))
+        if key.endswith(('_color', '_mark')) and not isinstance(value, str):
+            raise TypeError('{!r} should be a string'.format(key))
+    if 'color_span' in kwargs:
+        _check_color_span(kwargs['color_span'])
+    for key in ('show_header', 'markup'):
+        if key in kwargs:
+            kwargs[key] = bool(kwargs[key])
+
+    return _Configured(kwargs)
+
 
 def _get_color_and_mark(label_type, kwargs):
-    color = _layered_choice(kwargs.pop('color', None), custom_colors[label_type], default_colors[label_type])
-    mark = _layered_choice(kwargs.pop('mark', None), custom_marks[label_type], default_marks[label_type])
+    style = _current_style()
+    color = _layered_choice(kwargs.pop('color', None), style.colors[label_type])
+    mark = _layered_choice(kwargs.pop('mark', None), style.marks[label_type])
     return color, mark
 
 
+# Get the compiled template of a label of the given type printed to the given sink without per-call settings.
+def _get_type_template(label_type, sink, style):
+    key = (label_type, sink.tty, header_pattern, _output_format)
+    template = style.templates.get(key)
+    if template is None:
+        color, mark = style.colors[label_type], style.marks[label_type]
+        if _output_format == 'json':
+            return _cache_template(style.templates, key, _get_json_template(label_type, mark))
+        template = _cache_template(style.templates, key, _compile_label(
+            color, mark, style.color_span, style.show_header, sink.tty))
+    return template
+
+
 def _print_label_of_type(label_type, msg, **kwargs):
-    color, mark = _get_color_and_mark(label_type, kwargs)
-    _print_label(color, mark, msg, **kwargs)
+    style = _current_style()
+    if kwargs or style.markup:
+        color, mark = _get_color_and_mark(label_type, kwargs)
+        _print_label(color, mark, msg, label_type=label_type, **kwargs)
+        return
+
+    # Fast path for labels without per-call settings.
+    sink = _get_sink()
+    template = _get_type_template(label_type, sink, style)
+    _write_label(sink, template, msg, label_type=label_type)
 
 
 def section(msg, **kwargs):
@@ -515,42 +2737,304 @@ def progress(msg, mode=PROGRESS_STATIC, **kwargs):
     return ProgressLabel(mode, color, mark, msg, **kwargs)
 
 
+def progress_group(interval=0.1, file=None):
+    """Create a group of determinate progress bars displayed on consecutive lines."""
+    return ProgressGroup(interval, file)
+
+
+def track(iterable, msg, total=None, **kwargs):
+    """Iterate over the iterable, displaying its progress in a determinate progress label
+    (or a spinning one if the total number of items is unknown)."""
+    if total is None:
+        try:
+            total = len(iterable)
+        except TypeError:  # e.g. generators
+            pass
+
+    if not total:
+        with progress(msg, mode=PROGRESS_SPIN, **kwargs):
+            for item in iterable:
+                yield item
+        return
+
+    with progress(msg, mode=PROGRESS_DETERMINATE, total=total, **kwargs) as label:
+        stats = label.stats
+        count = done = 0
+        next_check = 1
+        for item in iterable:
+            yield item
+            count += 1
+            if count >= next_check:
+                label.advance(count - done)
+                done = count
+                # Check again after about the number of items done in a refreshing interval of the statistics.
+                next_check = count + max(1, int((stats.rate or 0) * _stats_interval))
+        label.advance(count - done)
+
+
+def aprogress(msg, mode=PROGRESS_SPIN, **kwargs):
+    """Display a progress label containing the given message, animated by the running asyncio event loop."""
+    color, mark = _get_color_and_mark('progress', kwargs)
+    _check_progress_mode(mode)
+    if mode == PROGRESS_STATIC:
+        raise ValueError('static progress labels cannot be used asynchronously, use progress() instead')
+    return AsyncProgressLabel(mode, color, mark, msg, **kwargs)
+
+
 def plain(msg, **kwargs):
     """Display a plain label containing the given message."""
     _print_label_of_type('plain', msg, **kwargs)
 
 
+class Label(object):
+    """A reusable label of the given type, with its settings resolved and its template rendered once,
+    so that calling it to display a message is very cheap."""
+
+    __slots__ = ('label_type', 'sink', 'template', 'markup', 'outer_color')
+
+    def __init__(self, label_type, **kwargs):
+        _check_value_in_list(label_type, 'label_type', _message_labels)
+
+        color, mark = _get_color_and_mark(label_type, kwargs)
+        self.label_type = label_type
+        self.sink = _get_sink(kwargs.get('file'))
+        self.template = _get_template(color, mark, self.sink, kwargs, label_type=label_type)
+
+        self.markup = _layered_choice(kwargs.get('markup'), _current_style().markup)
+        self.outer_color = _markup_outer_color(color, self.sink, kwargs)
+
+    def __repr__(self):
+        return 'Label({!r})'.format(self.label_type)
+
+    def __call__(self, msg):
+        """Display the label containing the given message."""
+        if self.markup:
+            msg = _render_markup(str(msg), self.outer_color)
+        template = self.template
+        if _suppressor is not None:
+            _write_label(self.sink, template, msg, label_type=self.label_type)
+        elif template[1] is None:
+            self.sink.write(_json_record(template, msg, _json_timestamp()), label_type=self.label_type)
+        else:
+            self.sink.write(template[0] + str(msg) + template[1], label_type=self.label_type)
+
+
 def question(msg, **kwargs):
     """Display a question label containing the given message and prompt for user input."""
     color, mark = _get_color_and_mark('question', kwargs)
-    return _input_label(color, mark, msg, **kwargs)
+    return _input_label('question', color, mark, msg, **kwargs)
 
 
 def input(msg, **kwargs):
     """Display an input label containing the given message and prompt for user input."""
     color, mark = _get_color_and_mark('input', kwargs)
-    return _input_label(color, mark, msg, **kwargs)
+    return _input_label('input', color, mark, msg, **kwargs)
 
 
 def password(msg, **kwargs):
     """Display a password label containing the given message and prompt for user input."""
     color, mark = _get_color_and_mark('password', kwargs)
-    _print_label(color, mark, msg, newline=False, **kwargs)
+    _print_label(color, mark, msg, newline=False, flush=True, label_type='password', **kwargs)
+    import getpass
     return getpass.getpass('')
 
 
-def newline():
-    """Print an empty line."""
-    _inline_write('\n')
+# Run a prompting label function in the default executor of the running event loop, and return an awaitable.
+def _prompt_in_executor(function, msg, kwargs):
+    return _get_running_loop().run_in_executor(None, lambda: function(msg, **kwargs))
+
+
+def aquestion(msg, **kwargs):
+    """Display a question label containing the given message and prompt for user input,
+    without blocking the running asyncio event loop. Return an awaitable of the input."""
+    return _prompt_in_executor(question, msg, kwargs)
+
 
+def ainput(msg, **kwargs):
+    """Display an input label containing the given message and prompt for user input,
+    without blocking the running asyncio event loop. Return an awaitable of the input."""
+    return _prompt_in_executor(input, msg, kwargs)
 
-if is_tty and platform.system() == 'Windows':  # Initialize colorama on Windows.
-    import colorama
-    colorama.init()
+
+def apassword(msg, **kwargs):
+    """Display a password label containing the given message and prompt for user input,
+    without blocking the running asyncio event loop. Return an awaitable of the password."""
+    return _prompt_in_executor(password, msg, kwargs)
+
+
+def emit_many(label_type, messages, **kwargs):
+    """Display a label of the given type for each message in an iterable.
+    Labels are rendered and written in chunks, which is much faster than printing them one by one."""
+
+    _check_value_in_list(label_type, 'label_type', _message_labels)
+
+    if kwargs:
+        color, mark = _get_color_and_mark(label_type, kwargs)
+        sink = _get_sink(kwargs.get('file'))
+        template = _get_template(color, mark, sink, kwargs, label_type=label_type)
+    else:
+        color, mark = _get_color_and_mark(label_type, {})
+        sink = _get_sink()
+        template = _get_type_template(label_type, sink, _current_style())
+    markup = _layered_choice(kwargs.get('markup'), _current_style().markup)
+
+    prefix, suffix = template
+    messages = iter(messages)
+    while True:
+        chunk = list(itertools.islice(messages, _emit_chunk_size))
+        if not chunk:
+            break
+        if markup:
+            chunk = [_apply_markup(color, msg, sink, kwargs) for msg in chunk]
+        if _suppressor is not None:
+            for msg in chunk:
+                _write_label(sink, template, msg, label_type=label_type)
+        elif suffix is None:
+            timestamp = _json_timestamp()
+            sink.write(''.join([_json_record(template, msg, timestamp) for msg in chunk]), label_type=label_type)
+        else:
+            sink.write(prefix + (suffix + prefix).join(map(str, chunk)) + suffix, label_type=label_type)
+
+
+def items(messages, **kwargs):
+    """Display an item label for each message in an iterable."""
+    emit_many('item', messages, **kwargs)
+
+
+def newline(**kwargs):
+    """Print an empty line (nothing in JSON output)."""
+    if _output_format == 'json':
+        return  # Empty lines are not valid JSON records.
+    _inline_write('\n', file=kwargs.get('file'))
+
+
+def flush():
+    """Write out all buffered label output."""
+    _flush_all()
+
+
+def text_width(s):
+    """Get the number of terminal columns a string takes up, ignoring ANSI escape sequences
+    and counting East Asian wide characters as two columns."""
+    if PY2 and isinstance(s, str):
+        s = s.decode('utf-8', 'replace')
+    if '\033' not in s and _is_ascii(s):
+        return len(s)
+    return _lru_get(_text_widths, s, _escaped_width, _max_text_widths)
+
+
+def truncate(s, width, placeholder=''):
+    """Truncate a string to fit the given number of terminal columns, keeping ANSI escape sequences.
+    The placeholder is appended if the string is truncated."""
+    _check_interger_minimum(width, 0, 'width')
+    if PY2 and isinstance(s, str):
+        s = s.decode('utf-8', 'replace')
+    if text_width(s) <= width:
+        return s
+
+    room = width - text_width(placeholder)
+    if room < 0:
+        return truncate(placeholder, width)  # the placeholder itself does not fit
+
+    out = []
+    escaped = False
+    for token, is_escape in _split_escapes(s):
+        if is_escape:
+            out.append(token)
+            escaped = True
+            continue
+        for char in token:
+            room -= _char_width(char) if char >= u'\x80' else 1
+            if room < 0:
+                break
+            out.append(char)
+        if room < 0:
+            break
+
+    if escaped:
+        out.append(COLOR_RESET)  # do not leak colors opened in the dropped part
+    return ''.join(out) + placeholder
+
+
+def load_recording(path):
+    """Load a recording saved by a Recorder, as a list of (time, label type, text) tuples."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(_recording_header):
+        raise ValueError('{!r} is not a recording of colorlabels'.format(path))
+    return _parse_records(data, len(_recording_header))
+
+
+def replay(recording, file=None, speed=1):
+    """Write recorded output to a stream, reproducing its original timing sped up by the given factor
+    (or without delays if speed is 0)."""
+    _check_nonnegative_number(speed, 'speed')
+
+    sink = _get_sink(file)
+    start = _monotonic()
+    for timestamp, _, text in _recording_records(recording):
+        if speed:
+            delay = timestamp / float(speed) - (_monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        sink.flush(text)
+
+
+def export_recording(recording, format='text'):
+    """Convert recorded output to plain text or HTML, as it finally appears on a terminal."""
+    _check_value_in_list(format, 'format', ('text', 'html'))
+
+    screen = _Screen()
+    for _, _, text in _recording_records(recording):
+        screen.feed(text)
+    return screen.text() if format == 'text' else screen.html()
+
+
+if sys.version_info < (3, 7):  # no module-level __getattr__()
+    _make_logging_classes()
+
+
+__all__ = ['color_code', 'color256', 'rgb', 'hex_color', 'BLACK', 'RED', 'GREEN', 'YELLOW', 'BLUE', 'MAGENTA',
+           'CYAN', 'WHITE', 'BRIGHT_BLACK', 'BRIGHT_RED', 'BRIGHT_GREEN', 'BRIGHT_YELLOW', 'BRIGHT_BLUE',
+           'BRIGHT_MAGENTA', 'BRIGHT_CYAN', 'BRIGHT_WHITE', 'BOLD', 'DIM', 'UNDERLINE', 'COLOR_RESET',
+           'PROGRESS_STATIC', 'PROGRESS_SPIN', 'PROGRESS_EXPAND', 'PROGRESS_MOVE', 'PROGRESS_DETERMINATE',
+           'config', 'configured', 'section', 'item', 'success', 'warning', 'error', 'info', 'progress',
+           'progress_group', 'track', 'aprogress', 'plain', 'Label', 'question', 'input', 'password', 'aquestion',
+           'ainput', 'apassword', 'emit_many', 'items', 'newline', 'flush', 'text_width', 'truncate',
+           'QueueStream', 'QueueListener', 'LabelHandler', 'LabelFormatter', 'Recorder', 'load_recording',
+           'replay', 'export_recording']
+
+
+# Replay or convert recordings from the command line.
+def _main(argv):
+    import argparse
+    import io
+
+    parser = argparse.ArgumentParser(prog='python -m colorlabels', description='Replay or convert recordings.')
+    subparsers = parser.add_subparsers(dest='command')
+    replay_parser = subparsers.add_parser('replay', help='replay a recording to the terminal')
+    replay_parser.add_argument('path', help='the recording file')
+    replay_parser.add_argument('--speed', type=float, default=1, help='speed up factor, 0 for no delays')
+    export_parser = subparsers.add_parser('export', help='convert a recording to plain text or HTML')
+    export_parser.add_argument('path', help='the recording file')
+    export_parser.add_argument('--format', choices=('text', 'html'), default='text', help='the output format')
+    export_parser.add_argument('--output', help='write to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.command == 'replay':
+        replay(args.path, speed=args.speed)
+    elif args.command == 'export':
+        output = export_recording(args.path, args.format)
+        if args.output:
+            with io.open(args.output, 'w', encoding='utf-8') as f:
+                f.write(output)
+        else:
+            sys.stdout.write(output)
+    else:
+        parser.print_help()
+        return 1
+    return 0
 
 
-__all__ = ['color_code', 'BLACK', 'RED', 'GREEN', 'YELLOW', 'BLUE', 'MAGENTA', 'CYAN', 'WHITE',
-           'BRIGHT_BLACK', 'BRIGHT_RED', 'BRIGHT_GREEN', 'BRIGHT_YELLOW', 'BRIGHT_BLUE', 'BRIGHT_MAGENTA',
-           'BRIGHT_CYAN', 'BRIGHT_WHITE', 'COLOR_RESET', 'PROGRESS_STATIC', 'PROGRESS_SPIN', 'PROGRESS_EXPAND',
-           'PROGRESS_MOVE', 'PROGRESS_DETERMINATE', 'config', 'section', 'item', 'success', 'warning', 'error',
-           'info', 'progress', 'plain', 'question', 'input', 'password', 'newline']
+if __name__ == '__main__':
+    sys.exit(_main(sys.argv[1:]))